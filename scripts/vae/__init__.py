@@ -0,0 +1,4 @@
+"""
+Models of makehuman morphs that run without makehuman: only numpy (and keras
+or tables where noted) is needed to load and evaluate them.
+"""
@@ -0,0 +1,199 @@
+"""
+Release benchmark of a neural model against the exact morph model.
+
+Draws a fixed, seeded set of param vectors (optionally with the edge cases
+of the data generation notebook: each param at 0 and 1, the others at 0.5),
+computes the ground truth vertex deltas with the exact morph model (see
+morph_model.py) and reports:
+
+    - per vertex L2 error of the model: mean, p95 and max, overall and by face group
+    - model inference throughput for several batch sizes
+    - morph model throughput for the same batch sizes
+
+The json report has the settings and file hashes of the run, so reports of
+different runs can be compared (--baseline), and gates a release with
+--max-mean-error / --max-regression (the exit code is 1 when a gate fails).
+
+Usage:
+    python -m scripts.vae.benchmark morph_model.npz model.hdf5 -l labels.json -o report.json [--baseline old_report.json] [--max-mean-error 0.01]
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .morph_model import MorphModel
+
+BATCH_SIZES = [1, 8, 32, 128]
+REPORT_VERSION = 1
+
+
+def draw_params(n, nb_params, seed=0, edges=False):
+    """n seeded uniform param vectors in [0, 1], after the edge cases if edges."""
+    params = [np.random.RandomState(seed).uniform(size=(n, nb_params))]
+    if edges:
+        edge = np.full((2 * nb_params, nb_params), 0.5)
+        edge[np.arange(nb_params), np.arange(nb_params)] = 1.0
+        edge[nb_params + np.arange(nb_params), np.arange(nb_params)] = 0.0
+        params.insert(0, edge)
+    return np.concatenate(params).astype(np.float32)
+
+
+def file_hash(filename):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fi:
+        for block in iter(lambda: fi.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _stats(dist):
+    return OrderedDict([('mean', float(dist.mean())),
+                        ('p95', float(np.percentile(dist, 95))),
+                        ('max', float(dist.max()))])
+
+
+def vertex_errors(pred, truth, morph_model=None):
+    """Per vertex L2 error statistics, overall and by face group (of the morph model)."""
+    dist = np.sqrt(((np.asarray(pred, dtype=np.float64) - truth) ** 2).sum(axis=-1))
+    result = OrderedDict([('all', _stats(dist))])
+    if morph_model is not None and morph_model.vertex_group is not None:
+        groups = OrderedDict()
+        for g, name in enumerate(morph_model.face_groups):
+            verts = np.flatnonzero(morph_model.vertex_group == g)
+            if len(verts):
+                groups[name] = _stats(dist[:, verts])
+        result['face_groups'] = groups
+    return result
+
+
+def throughput(predict, params, batch_sizes=BATCH_SIZES, repeats=3, min_samples=64):
+    """Samples per second of predict(batch) for each batch size (best of repeats)."""
+    result = OrderedDict()
+    for batchSize in batch_sizes:
+        n = max(min_samples, batchSize)
+        batches = [params.take(np.arange(i, i + batchSize), axis=0, mode='wrap') for i in range(0, n, batchSize)]
+        predict(batches[0])  # warm up
+        best = None
+        for _ in range(repeats):
+            t = time.time()
+            for batch in batches:
+                predict(batch)
+            elapsed = time.time() - t
+            best = elapsed if best is None else min(best, elapsed)
+        result[str(batchSize)] = sum(len(b) for b in batches) / max(best, 1e-9)
+    return result
+
+
+def run(morph_model_file, model_file, labels, n_samples=256, seed=0, edges=False,
+        batch_sizes=BATCH_SIZES, weights=None, quantized=None):
+    """Run the benchmark, returns the report as a dict."""
+    from .quantize import load_model, QuantizedWeights, set_model_weights
+    morph = MorphModel.load(morph_model_file)
+    model = load_model(model_file, weights)
+    if quantized:
+        set_model_weights(model, QuantizedWeights.load(quantized).dequantized())
+
+    params = draw_params(n_samples, len(labels), seed, edges)
+    reference = morph.coords(morph.reference_values(labels))
+
+    def exact(batch):
+        return morph.coords(morph.params_to_values(batch, labels)) - reference
+
+    truth = np.concatenate([exact(params[i:i+128]) for i in range(0, len(params), 128)])
+    pred = model.predict(params, batch_size=32).reshape(truth.shape)
+
+    files = OrderedDict([('morph_model', morph_model_file), ('model', model_file)])
+    if weights:
+        files['weights'] = weights
+    if quantized:
+        files['quantized'] = quantized + '.buf'
+    return OrderedDict([
+        ('version', REPORT_VERSION),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('settings', OrderedDict([('samples', len(params)), ('seed', seed), ('edges', edges),
+                                  ('batch_sizes', list(batch_sizes))])),
+        ('files', OrderedDict((k, OrderedDict([('path', f), ('sha1', file_hash(f))])) for k, f in files.items())),
+        ('vertex_error', vertex_errors(pred, truth, morph)),
+        ('model_throughput', throughput(lambda b: model.predict(b, batch_size=len(b)), params, batch_sizes)),
+        ('exact_throughput', throughput(exact, params, batch_sizes)),
+    ])
+
+
+def compare(report, baseline, max_mean_error=None, max_regression=None):
+    """
+    Print the changes against a baseline report (may be None) and check the
+    gates. Returns the list of failed gates.
+    """
+    failures = []
+    error = report['vertex_error']['all']
+    if baseline is not None:
+        if baseline['settings'] != report['settings']:
+            print('warning: settings differ from the baseline, %s != %s' % (report['settings'], baseline['settings']))
+        old = baseline['vertex_error']['all']
+        for key in error:
+            print('vertex error %-5s %12.6g -> %12.6g (%+.1f%%)' % (key, old[key], error[key],
+                                                                  100 * (error[key] - old[key]) / max(old[key], 1e-12)))
+        for name in ('model_throughput', 'exact_throughput'):
+            for batchSize, value in report[name].items():
+                if batchSize in baseline[name]:
+                    print('%s batch %4s %10.1f -> %10.1f samples/s' % (name, batchSize, baseline[name][batchSize], value))
+        if max_regression is not None and error['mean'] > old['mean'] * (1 + max_regression):
+            failures.append('mean vertex error %.6g regressed more than %.0f%% from %.6g' % (
+                error['mean'], 100 * max_regression, old['mean']))
+    if max_mean_error is not None and error['mean'] > max_mean_error:
+        failures.append('mean vertex error %.6g > %.6g' % (error['mean'], max_mean_error))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark a keras model against the exact morph model.')
+    parser.add_argument('morph_model', help='Morph model (.npz), see wrap_mh/morph_export.py')
+    parser.add_argument('model', help='Keras model (.hdf5), or model json (with --weights)')
+    parser.add_argument('-w', '--weights', default=None, help='Weights file, for a model json')
+    parser.add_argument('-q', '--quantized', default=None, help='Use quantized weights (prefix), see quantize.py')
+    parser.add_argument('-l', '--labels', default=None,
+                        help='json list of the modifier of each model input (labels.json), default sorted modifier names')
+    parser.add_argument('-n', '--samples', type=int, default=256)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--edges', action='store_true', help='Also test each param at 0 and 1')
+    parser.add_argument('--batch-sizes', default=','.join(map(str, BATCH_SIZES)))
+    parser.add_argument('-o', '--output', default=None, help='Write the report to this json file')
+    parser.add_argument('--baseline', default=None, help='Report to compare with')
+    parser.add_argument('--max-mean-error', type=float, default=None, help='Fail if the mean vertex error is larger')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='Fail if the mean vertex error is this fraction larger than the baseline')
+    options = parser.parse_args(argv)
+
+    if options.labels:
+        with open(options.labels) as fi:
+            labels = json.load(fi)
+    else:
+        labels = sorted(MorphModel.load(options.morph_model).modifier_names)
+    report = run(options.morph_model, options.model, labels, options.samples, options.seed, options.edges,
+                 [int(b) for b in options.batch_sizes.split(',')], options.weights, options.quantized)
+    for key, value in report['vertex_error']['all'].items():
+        print('vertex error %-5s %12.6g' % (key, value))
+    for name in ('model_throughput', 'exact_throughput'):
+        print('%s: %s' % (name, ', '.join('batch %s: %.1f/s' % item for item in report[name].items())))
+    if options.output:
+        with open(options.output, 'w') as fo:
+            json.dump(report, fo, indent=2)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as fi:
+            baseline = json.load(fi, object_pairs_hook=OrderedDict)
+    failures = compare(report, baseline, options.max_mean_error, options.max_regression)
+    for failure in failures:
+        print('FAILED: %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Arrays in one binary blob (<prefix>.buf) with a json layout (<prefix>.json),
+the format of the quantized weights (quantize.py) and the response tables
+(responses.py) of the browser model.
+
+Every array starts at a multiple of 4 bytes of the blob, so the browser can
+view it as a typed array. The layout has a "version" and the offsets of the
+arrays, its other contents depend on the format.
+"""
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BlobWriter(object):
+    """Concatenates arrays into a blob, each one padded to a multiple of 4 bytes."""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def append(self, array):
+        """Append an array, returns its offset and its length (without padding) in bytes."""
+        data = np.ascontiguousarray(array).tobytes()
+        start = self.size
+        self.parts.append(data + b'\0' * (-len(data) % 4))
+        self.size += len(self.parts[-1])
+        return start, len(data)
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class BlobFile(object):
+    """
+    A blob and its layout, saved as <prefix>.buf and <prefix>.json.
+    Subclasses set the layout VERSION they read and a DESCRIPTION for errors.
+    """
+
+    VERSION = None
+    DESCRIPTION = 'blob'
+
+    def __init__(self, blob, layout):
+        self.blob = blob
+        self.layout = layout
+
+    def save(self, prefix):
+        with open(prefix + '.buf', 'wb') as fo:
+            fo.write(self.blob)
+        with open(prefix + '.json', 'w') as fo:
+            json.dump(self.layout, fo, indent=1)
+
+    @classmethod
+    def load(cls, prefix):
+        with open(prefix + '.buf', 'rb') as fi:
+            blob = fi.read()
+        with open(prefix + '.json', 'r') as fi:
+            layout = json.load(fi, object_pairs_hook=OrderedDict)
+        if layout.get('version') != cls.VERSION:
+            raise ValueError('Unsupported %s version %s' % (cls.DESCRIPTION, layout.get('version')))
+        return cls(blob, layout)
@@ -0,0 +1,446 @@
+"""
+Inverse fitting: recover the modifier values of meshes in base mesh topology
+(eg. scans registered to the base mesh, or earlier exports) with a morph
+model (see morph_model.py).
+
+The coordinates of a human are base + D.T w(values), with D the target
+offsets and w the target weights, so the squared error to a mesh y is
+
+    f(values) = w.G.w - 2 w.c + |y - base|^2
+
+with G = D D.T the Gram matrix of the targets (computed once per morph
+model) and c = D (y - base) (once per mesh). Fitting works in target space
+and never evaluates the full mesh: a projected Levenberg-Marquardt
+(bounded Gauss-Newton) iteration over the modifier values, with the
+derivatives of the target weights from one sided differences of the
+(piecewise linear) factors. At a kink (eg. a universal modifier at 0) the
+side in which the error decreases is used.
+
+The kinks make the error non convex, so fits are warm started from the
+best few of a set of candidate values (by default seeded random params, or
+the params of a training set), found exactly with the same quadratic form,
+and the best fit is kept. A fit can still stall in a local minimum inside a
+linear piece, so converged fits are retried with each modifier restarted on
+the other sides of its kinks, keeping the better fits.
+
+Usage:
+    python -m scripts.vae.fit morph_model.npz mesh.obj [mesh2.obj ...] -o specs.jsonl [--gram gram.npy] [-d data_dir]
+
+Check that the fitter recovers random humans of the morph model (exit code 1
+if a fit has an RMS vertex error above --max-rms):
+    python -m scripts.vae.fit morph_model.npz --check 20
+
+The output is a JSONL file of human specs, as read by wrap_mh/batch.py.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .morph_model import MorphModel, ETHNICS
+
+# step of the one sided differences of the factors. They are piecewise
+# linear, so the differences are exact away from the kinks, and closer to a
+# kink they mix in the slope beyond it, which lets a fit cross the kink.
+STEP = 1e-2
+
+
+def target_gram(model, block_size=128):
+    """Gram matrix (nTargets, nTargets) of the target offsets, computed in dense blocks."""
+    nTargets = model.nTargets
+    gram = np.zeros((nTargets, nTargets))
+    blocks = [np.arange(i, min(i + block_size, nTargets)) for i in range(0, nTargets, block_size)]
+
+    def dense(block):
+        result = np.zeros((len(block),) + model.base.shape)
+        for i, t in enumerate(block):
+            verts, offsets = model.target_offsets(t)
+            result[i, verts] = offsets
+        return result.reshape(len(block), -1)
+
+    for a, blockA in enumerate(blocks):
+        denseA = dense(blockA)
+        for blockB in blocks[a:]:
+            denseB = denseA if blockB is blockA else dense(blockB)
+            gram[np.ix_(blockA, blockB)] = denseA.dot(denseB.T)
+            gram[np.ix_(blockB, blockA)] = gram[np.ix_(blockA, blockB)].T
+    return gram
+
+
+def read_obj_vertices(filename):
+    """Vertex coordinates (nVerts, 3) of an obj file."""
+    coords = []
+    with open(filename, 'r') as fi:
+        for line in fi:
+            if line.startswith('v '):
+                coords.append([float(v) for v in line.split()[1:4]])
+    return np.array(coords)
+
+
+class MeshFitter(object):
+    """Fit modifier values to meshes, see the module docstring."""
+
+    def __init__(self, model, gram=None):
+        self.model = model
+        self.gram = target_gram(model) if gram is None else gram
+        if self.gram.shape != (model.nTargets, model.nTargets):
+            raise ValueError('Gram matrix of shape %s does not match %s targets' % (self.gram.shape, model.nTargets))
+        self._build_entries()
+
+    def _build_entries(self):
+        """
+        The (target, modifier) entries of the derivatives of the target
+        weights, and the terms (target slot, derivative source) they sum.
+        """
+        model = self.model
+        col = model._factor_column
+        self._ethnic_cols = [col[name] for name in ETHNICS]
+        self._ethnic_mods = [j for j, m in enumerate(model.modifiers) if m.get('variable') in ETHNICS]
+        self._other_mods = [j for j in range(len(model.modifiers)) if j not in self._ethnic_mods]
+        nCols = len(model.factor_names)
+
+        # derivative sources: column c for the derivative of factor c by its
+        # (single) modifier, nCols + 3*a + b for ethnic factor a by ethnic modifier b
+        sources = {}
+        for j in self._other_mods:
+            for name in model.modifier_factors(j):
+                sources.setdefault(col[name], []).append((j, col[name]))
+        for b, j in enumerate(self._ethnic_mods):
+            for a, c in enumerate(self._ethnic_cols):
+                sources.setdefault(c, []).append((j, nCols + 3 * a + b))
+
+        terms = []
+        index = model._factor_index
+        for t in range(model.nTargets):
+            for k, c in enumerate(index[t]):
+                for j, source in sources.get(c, []):
+                    terms.append((j, t, k, source))
+        terms.sort()
+        terms = np.array(terms, dtype=np.intp).reshape(-1, 4)
+        entryKeys, entryStart = np.unique(terms[:, 0] * model.nTargets + terms[:, 1], return_index=True)
+        self._term_target, self._term_slot, self._term_source = terms[:, 1], terms[:, 2], terms[:, 3]
+        self._term_starts = entryStart
+        self.entry_modifier = entryKeys // model.nTargets
+        self.entry_target = entryKeys % model.nTargets
+        # entries are sorted by modifier
+        self.modifiers_fitted, self._modifier_starts = np.unique(self.entry_modifier, return_index=True)
+        self._entry_gram = self.gram[np.ix_(self.entry_target, self.entry_target)]
+
+    def correlations(self, coords, chunk_size=16):
+        """c = D (coords - base), (N, nTargets), and |coords - base|^2 (N,)."""
+        model = self.model
+        coords = np.asarray(coords, dtype=np.float64).reshape((-1,) + model.base.shape)
+        if coords.shape[1:] != model.base.shape:
+            raise ValueError('Meshes of %s vertices do not match the base mesh (%s)' % (coords.shape[1], len(model.base)))
+        c = np.empty((len(coords), model.nTargets))
+        norms = np.empty(len(coords))
+        for i in range(0, len(coords), chunk_size):
+            delta = coords[i:i+chunk_size] - model.base
+            norms[i:i+chunk_size] = (delta ** 2).sum(axis=(1, 2))
+            for t in range(model.nTargets):
+                verts, offsets = model.target_offsets(t)
+                c[i:i+chunk_size, t] = np.einsum('nvk,vk->n', delta[:, verts], offsets)
+        return c, norms
+
+    def errors(self, values, c, norms):
+        """Squared errors (N,) of meshes (given by correlations()) for values."""
+        w = self.model.target_weights(values)
+        return np.einsum('nt,nt->n', w.dot(self.gram), w) - 2 * (w * c).sum(axis=1) + norms
+
+    def nearest(self, candidates, c, norms, k=1, chunk_size=1024):
+        """Indices (N, k) of the k candidate values with the smallest errors for each mesh, best first."""
+        k = min(k, len(candidates))
+        best = np.zeros((len(c), 0), dtype=np.intp)
+        bestErrors = np.zeros((len(c), 0))
+        for i in range(0, len(candidates), chunk_size):
+            w = self.model.target_weights(candidates[i:i+chunk_size])
+            quad = np.einsum('kt,kt->k', w.dot(self.gram), w)
+            errors = np.hstack([bestErrors, quad[None, :] - 2 * c.dot(w.T) + norms[:, None]])
+            indices = np.hstack([best, np.tile(i + np.arange(len(w)), (len(c), 1))])
+            rows = np.arange(len(c))[:, None]
+            order = np.argsort(errors, axis=1)[:, :k]
+            best, bestErrors = indices[rows, order], errors[rows, order]
+        return best
+
+    def _factor_derivatives(self, values, side):
+        """One sided derivatives of the factors, by derivative source (see _build_entries())."""
+        model = self.model
+        h = side * STEP
+        factors = model.factors(values, clip=False)
+        result = np.zeros((len(values), len(model.factor_names) + 9))
+        shifted = values.copy()
+        shifted[:, self._other_mods] += h
+        result[:, :len(model.factor_names)] = (model.factors(shifted, clip=False) - factors) / h
+        for b, j in enumerate(self._ethnic_mods):
+            shifted = values.copy()
+            shifted[:, j] += h
+            diff = (model.factors(shifted, clip=False)[:, self._ethnic_cols] - factors[:, self._ethnic_cols]) / h
+            for a in range(len(ETHNICS)):
+                result[:, len(model.factor_names) + 3 * a + b] = diff[:, a]
+        return factors, result
+
+    def _weight_derivatives(self, values, side):
+        """Derivatives (N, nEntries) of the target weights of the entries."""
+        factors, derivatives = self._factor_derivatives(values, side)
+        slots = factors[:, self.model._factor_index]  # (N, nTargets, nSlots)
+        others = np.empty_like(slots)
+        for k in range(slots.shape[2]):
+            others[:, :, k] = np.prod(np.delete(slots, k, axis=2), axis=2)
+        terms = others[:, self._term_target, self._term_slot] * derivatives[:, self._term_source]
+        return np.add.reduceat(terms, self._term_starts, axis=1)
+
+    def fit(self, coords, start=None, candidates=None, starts=1, iterations=30, tolerance=1e-10, damping=1e-3,
+            kink_rounds=4):
+        """
+        Fit modifier values (N, nModifiers) to meshes coords (N, nVerts, 3).
+        start gives the initial values, by default the fits start from the
+        best starts candidates (the best fit is kept), or the defaults.
+        Then the fits are retried from the other sides of the kinks of each
+        modifier (see _retry_kinks()), up to kink_rounds times while that
+        improves them.
+        Returns the values and the RMS vertex error of each mesh.
+        """
+        model = self.model
+        c, norms = self.correlations(coords)
+        if start is not None or candidates is None:
+            values = model.values_array(np.tile(model.defaults, (len(c), 1)) if start is None else start)
+            values, errors = self._fit(values, c, norms, iterations, tolerance, damping)
+        else:
+            # the fits of all starts in one batch, mesh major
+            candidates = model.values_array(candidates)
+            best = self.nearest(candidates, c, norms, starts)
+            k = best.shape[1]
+            values, errors = self._fit(candidates[best.ravel()], np.repeat(c, k, axis=0), np.repeat(norms, k),
+                                       iterations, tolerance, damping)
+            choice = errors.reshape(-1, k).argmin(axis=1) + k * np.arange(len(c))
+            values, errors = values[choice], errors[choice]
+        retry = np.arange(len(c))
+        for _ in range(kink_rounds):
+            if not len(retry):
+                break
+            values, errors, improved = self._retry_kinks(values, errors, c, norms, retry,
+                                                         iterations, tolerance, damping)
+            retry = retry[improved]
+        return values, np.sqrt(np.maximum(errors, 0) / len(model.base))
+
+    def _kink_pieces(self):
+        """(modifier, start, end) of the linear pieces of the fitted modifiers with kinks."""
+        model = self.model
+        result = []
+        for j in self.modifiers_fitted:
+            kinks = model.modifier_kinks(j)
+            if kinks:
+                bounds = [model.mins[j]] + kinks + [model.maxs[j]]
+                result.extend((j, a, b) for a, b in zip(bounds[:-1], bounds[1:]))
+        return result
+
+    def _retry_kinks(self, values, errors, c, norms, rows, iterations, tolerance, damping):
+        """
+        The error has local minima inside the linear pieces between the kinks
+        (eg. a macro modifier at 0.5 or a universal modifier at 0), where the
+        fit stalls. Refit the meshes rows with each modifier in turn restarted
+        from the middle of each of its other pieces, and keep the refits that
+        are better. Returns the values, errors and which of rows improved.
+        """
+        values, errors = values.copy(), errors.copy()
+        pieces = self._kink_pieces()
+        starts = [(i, j, (a + b) / 2.0) for i in rows for j, a, b in pieces if not a <= values[i, j] <= b]
+        if not starts:
+            return values, errors, np.zeros(len(rows), dtype=bool)
+        starts = np.array(starts)
+        meshes = starts[:, 0].astype(np.intp)
+        trial = values[meshes]
+        trial[np.arange(len(starts)), starts[:, 1].astype(np.intp)] = starts[:, 2]
+        trial, trialErrors = self._fit(trial, c[meshes], norms[meshes], iterations, tolerance, damping)
+
+        improved = np.zeros(len(values), dtype=bool)
+        for n in np.argsort(trialErrors):
+            # the best refit of each mesh comes first
+            i = meshes[n]
+            if trialErrors[n] < errors[i] - tolerance * max(norms[i], 1e-12):
+                values[i], errors[i] = trial[n], trialErrors[n]
+                improved[i] = True
+        return values, errors, improved[rows]
+
+    def _fit(self, values, c, norms, iterations, tolerance, damping):
+        """Projected Levenberg-Marquardt from values, returns the values and the squared errors."""
+        model = self.model
+        values = values.copy()
+        errors = self.errors(values, c, norms)
+        lam = np.full(len(c), damping)
+        fitted = self.modifiers_fitted
+        lo, hi = model.mins[fitted], model.maxs[fitted]
+        active = np.ones(len(c), dtype=bool)
+
+        for _ in range(iterations):
+            if not active.any():
+                break
+            idx = np.flatnonzero(active)
+            v = values[idx]
+            residual = model.target_weights(v).dot(self.gram) - c[idx]  # half gradient by weight
+            derivs = []
+            grads = []
+            for side in (1, -1):
+                d = self._weight_derivatives(v, side)
+                derivs.append(d)
+                grads.append(np.add.reduceat(d * residual[:, self.entry_target], self._modifier_starts, axis=1))
+            # use the backward derivative where the error decreases faster going down
+            useBackward = grads[1] > np.maximum(0.0, -grads[0])
+            entryBackward = useBackward[:, np.searchsorted(fitted, self.entry_modifier)]
+            d = np.where(entryBackward, derivs[1], derivs[0])
+            g = np.where(useBackward, grads[1], grads[0])
+
+            steps = np.zeros((len(idx), len(fitted)))
+            for i in range(len(idx)):
+                x = values[idx[i], fitted]
+                weighted = d[i][:, None] * self._entry_gram * d[i][None, :]
+                hess = np.add.reduceat(np.add.reduceat(weighted, self._modifier_starts, axis=0),
+                                       self._modifier_starts, axis=1)
+                free = ~(((x <= lo) & (g[i] > 0)) | ((x >= hi) & (g[i] < 0)))
+                hf = hess[np.ix_(free, free)]
+                hf = hf + lam[idx[i]] * np.diag(np.diag(hf)) + 1e-12 * np.eye(len(hf))
+                steps[i, free] = -np.linalg.solve(hf, g[i][free])
+
+            # backtracking on the exact error
+            accepted = np.zeros(len(idx), dtype=bool)
+            scale = np.ones(len(idx))
+            for _ in range(8):
+                todo = ~accepted
+                if not todo.any():
+                    break
+                trial = values[idx[todo]].copy()
+                trial[:, fitted] = np.clip(trial[:, fitted] + scale[todo, None] * steps[todo], lo, hi)
+                trialErrors = self.errors(trial, c[idx[todo]], norms[idx[todo]])
+                better = trialErrors < errors[idx[todo]]
+                rows = np.flatnonzero(todo)[better]
+                improvement = errors[idx[rows]] - trialErrors[better]
+                values[idx[rows]] = trial[better]
+                errors[idx[rows]] = trialErrors[better]
+                accepted[rows] = True
+                # converged when the improvement is negligible
+                done = improvement <= tolerance * np.maximum(norms[idx[rows]], 1e-12)
+                active[idx[rows[done]]] = False
+                scale[todo] *= 0.5
+            lam[idx[accepted]] = np.maximum(lam[idx[accepted]] * 0.3, 1e-9)
+            lam[idx[~accepted]] *= 10
+            # no step improves even with a large damping, at a (local) minimum
+            active[idx[~accepted & (lam[idx] > 1e6)]] = False
+        return values, errors
+
+    def normalized_values(self, values):
+        """Values with the ethnic values normalized to sum to 1, as makehuman has them."""
+        values = np.array(values)
+        if self._ethnic_mods:
+            total = values[:, self._ethnic_mods].sum(axis=1, keepdims=True)
+            values[:, self._ethnic_mods] = np.where(total > 0, values[:, self._ethnic_mods] / np.where(total > 0, total, 1),
+                                                   1.0 / len(self._ethnic_mods))
+        return values
+
+
+def recovery_check(fitter, n=20, seed=1, **fit_options):
+    """
+    Round trip check of the fitter: fit the meshes of n seeded random humans
+    of the morph model itself, which can be recovered exactly. Returns the
+    true and the fitted values and the RMS vertex error of each fit.
+    """
+    from .benchmark import draw_params
+    model = fitter.model
+    values = model.params_to_values(draw_params(n, len(model.modifier_names), seed))
+    fitted, rms = fitter.fit(model.coords(values), **fit_options)
+    return values, fitted, rms
+
+
+def load_gram(model, filename=None):
+    """The Gram matrix of a morph model, cached in filename (computed and saved if missing)."""
+    if filename and os.path.isfile(filename):
+        gram = np.load(filename)
+        if gram.shape == (model.nTargets, model.nTargets):
+            return gram
+    gram = target_gram(model)
+    if filename:
+        np.save(filename, gram)
+    return gram
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit modifier values to meshes in base mesh topology.')
+    parser.add_argument('morph_model', help='Morph model (.npz), see wrap_mh/morph_export.py')
+    parser.add_argument('meshes', nargs='*', help='obj files, or npy files with a stack of coordinates (N, nVerts, 3)')
+    parser.add_argument('-o', '--output', default=None, help='JSONL file of human specs')
+    parser.add_argument('--gram', default=None, help='Cache file (.npy) for the Gram matrix of the targets')
+    parser.add_argument('-d', '--data-dir', default=None, help='Training set whose params are the warm start candidates')
+    parser.add_argument('--candidates', type=int, default=1024, help='Number of random candidates, without --data-dir')
+    parser.add_argument('-s', '--starts', type=int, default=4, help='Fit from this many of the best candidates')
+    parser.add_argument('-i', '--iterations', type=int, default=30)
+    parser.add_argument('--kink-rounds', type=int, default=4, help='Rounds of refits from the other sides of the kinks')
+    parser.add_argument('--check', type=int, default=0,
+                        help='Instead of fitting meshes, check that this many random humans of the morph model are recovered')
+    parser.add_argument('--max-rms', type=float, default=1e-4, help='Fail the check if a fit has a larger RMS vertex error')
+    options = parser.parse_args(argv)
+    if not options.check and not (options.meshes and options.output):
+        parser.error('give meshes and --output, or --check')
+
+    model = MorphModel.load(options.morph_model)
+    t = time.time()
+    fitter = MeshFitter(model, load_gram(model, options.gram))
+    print('Prepared fitter for %s targets in %.1fs' % (model.nTargets, time.time() - t))
+
+    if options.data_dir:
+        import tables
+        from .morph_model import read_dataset
+        labels = read_dataset(options.data_dir, 0, 0)[0]
+        with tables.open_file(os.path.join(options.data_dir, 'y_train.hdf5'), 'r') as fi:
+            params = fi.root.data[:]
+        candidates = model.params_to_values(params, labels)
+    else:
+        from .benchmark import draw_params
+        candidates = model.params_to_values(draw_params(options.candidates, len(model.modifier_names)))
+    candidates = np.vstack([model.defaults, candidates])
+    fitOptions = dict(candidates=candidates, starts=options.starts, iterations=options.iterations,
+                      kink_rounds=options.kink_rounds)
+
+    if options.check:
+        t = time.time()
+        values, fitted, rms = recovery_check(fitter, options.check, **fitOptions)
+        valueErrors = np.abs(fitter.normalized_values(fitted) - fitter.normalized_values(values)).max(axis=1)
+        failed = rms > options.max_rms
+        print('Fitted %s random humans in %.1fs, RMS vertex error mean %.4g, max %.4g, max value error %.4g' % (
+            len(values), time.time() - t, rms.mean(), rms.max(), valueErrors.max()))
+        if failed.any():
+            print('%s fits have an RMS vertex error above %s: %s' % (
+                failed.sum(), options.max_rms, ', '.join('%d (%.4g)' % (i, rms[i]) for i in np.flatnonzero(failed))))
+            return 1
+        return 0
+
+    names = []
+    coords = []
+    for filename in options.meshes:
+        base = os.path.splitext(os.path.basename(filename))[0]
+        if filename.endswith('.npy'):
+            stack = np.load(filename)
+            names.extend('%s_%d' % (base, i) for i in range(len(stack)))
+            coords.extend(stack)
+        else:
+            names.append(base)
+            coords.append(read_obj_vertices(filename))
+
+    t = time.time()
+    values, rms = fitter.fit(np.array(coords), **fitOptions)
+    values = fitter.normalized_values(values)
+    print('Fitted %s meshes in %.1fs, RMS vertex error mean %.4g, max %.4g' % (len(values), time.time() - t, rms.mean(), rms.max()))
+    with open(options.output, 'w') as fo:
+        for name, row, error in zip(names, values, rms):
+            spec = OrderedDict([('name', name),
+                                ('modifier', OrderedDict((m, float(v)) for m, v in zip(model.modifier_names, row))),
+                                ('fit_rms', float(error))])
+            fo.write(json.dumps(spec) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+Nearest neighbour index over the humans of a training set, to find the
+closest existing human to a mesh or to a set of measurements (eg. to reuse a
+cached export of a near duplicate instead of making a new human).
+
+Each sample gets a low dimensional shape code:
+    - pca: the first coefficients of a PCA basis of the vertex deltas (see
+      pca.py), so the code distance approximates the L2 distance of the meshes
+    - measurements: a vector of measurements of each sample (made with the
+      makehuman MeasurementEngine, see wrap_mh/measure_dataset.py),
+      standardized per column
+
+The index is an inverted file (IVF): k-means centroids of the codes, and the
+samples sorted by nearest centroid. A query scans the samples of the nprobe
+nearest centroids exactly. The index file (.npz) holds everything a query
+needs (codes, params, the basis of pca codes and the reference coordinates
+for mesh queries), so it is loaded without the training set.
+
+Usage:
+    python -m scripts.vae.index build data_dir -o index.npz --basis basis.npz [--dims 32] [--morph-model morph_model.npz]
+    python -m scripts.wrap_mh.measure_dataset data_dir morph_model.npz -o measurements.npz
+    python -m scripts.vae.index build data_dir -o index.npz --measurements measurements.npz
+    python -m scripts.vae.index query index.npz mesh.obj [-k 5] [--nprobe 8]
+    python -m scripts.vae.index query index.npz measurements.json
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+INDEX_VERSION = 1
+CODE_TYPES = ['pca', 'measurements']
+
+
+def kmeans(data, k, iterations=10, sample_size=65536, seed=0):
+    """Centroids (k, dims) of data by Lloyd iterations on a random sample."""
+    rng = np.random.RandomState(seed)
+    if len(data) > sample_size:
+        data = data[np.sort(rng.choice(len(data), sample_size, replace=False))]
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        # an empty cluster keeps its centroid
+        nonEmpty = counts > 0
+        centroids[nonEmpty] = sums[nonEmpty] / counts[nonEmpty, None]
+    return centroids
+
+
+def squared_distances(a, b):
+    """Squared L2 distances (len(a), len(b))."""
+    return np.maximum((a ** 2).sum(axis=1)[:, None] - 2 * a.dot(b.T) + (b ** 2).sum(axis=1)[None, :], 0)
+
+
+def assign(data, centroids, chunk_size=4096):
+    """Index of the nearest centroid of each row."""
+    return np.concatenate([squared_distances(data[i:i+chunk_size], centroids).argmin(axis=1)
+                           for i in range(0, len(data), chunk_size)])
+
+
+def pca_codes(filename, basis, chunk_size=512):
+    """PCA coefficients (N, rank) of all vertex deltas of an HDF5 file, streamed."""
+    from .pca import iter_chunks
+    codes = []
+    for _, rows in iter_chunks(filename, chunk_size):
+        codes.append(basis.transform(rows).astype(np.float32))
+    return np.concatenate(codes)
+
+
+class HumanIndex(object):
+    """
+    IVF index of shape codes (see the module docstring). The samples are
+    stored in list order: list l holds the rows offsets[l]:offsets[l+1], and
+    ids are the rows of the samples in the training set.
+    """
+
+    def __init__(self, code_type, centroids, offsets, ids, codes, params, meta, shift=None, scale=None,
+                 mean=None, components=None, reference=None):
+        self.code_type = code_type
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.float32)
+        self.params = np.asarray(params, dtype=np.float32)
+        # labels (param names), code names (measurements) and build settings
+        self.meta = meta
+        # standardization of measurement codes
+        self.shift = shift
+        self.scale = scale
+        # pca basis, and reference coordinates for mesh queries
+        self.mean = mean
+        self.components = components
+        self.reference = reference
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def labels(self):
+        return self.meta.get('labels', [])
+
+    @classmethod
+    def build(cls, code_type, codes, params, meta, n_lists=None, shift=None, scale=None, **kwargs):
+        """Index codes (N, dims), standardized as (codes - shift) / scale if given."""
+        codes = np.asarray(codes, dtype=np.float32)
+        if shift is not None:
+            codes = (codes - shift) / scale
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(len(codes))))
+        centroids = kmeans(codes, n_lists)
+        labels = assign(codes, centroids)
+        order = np.argsort(labels, kind='mergesort')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(centroids)))])
+        return cls(code_type, centroids, offsets, order, codes[order], np.asarray(params)[order], meta,
+                   shift, scale, **kwargs)
+
+    def save(self, filename):
+        arrays = dict(centroids=self.centroids, offsets=self.offsets, ids=self.ids, codes=self.codes,
+                      params=self.params)
+        for name in ('shift', 'scale', 'mean', 'components', 'reference'):
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        meta = dict(self.meta, version=INDEX_VERSION, code_type=self.code_type)
+        arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf8'), dtype=np.uint8)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        npz = np.load(filename)
+        meta = json.loads(npz['meta'].tobytes().decode('utf8'), object_pairs_hook=OrderedDict)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError('Unsupported index version %s' % meta.get('version'))
+        optional = dict((name, npz[name] if name in npz.files else None)
+                        for name in ('shift', 'scale', 'mean', 'components', 'reference'))
+        return cls(meta['code_type'], npz['centroids'], npz['offsets'], npz['ids'], npz['codes'], npz['params'],
+                   meta, **optional)
+
+    def encode_deltas(self, deltas):
+        """Codes (N, dims) of vertex deltas (N, nVerts, 3), for a pca index."""
+        if self.code_type != 'pca':
+            raise ValueError('A %s index has no codes for meshes' % self.code_type)
+        deltas = np.asarray(deltas, dtype=np.float64)
+        return (deltas.reshape(len(deltas), -1) - self.mean).dot(self.components.T).astype(np.float32)
+
+    def encode_coords(self, coords):
+        """Codes of mesh coordinates (N, nVerts, 3), relative to the reference human of the training set."""
+        if self.reference is None:
+            raise ValueError('Index has no reference coordinates, build it with a morph model')
+        coords = np.asarray(coords).reshape((-1,) + self.reference.shape)
+        return self.encode_deltas(coords - self.reference)
+
+    def encode_measurements(self, measurements):
+        """Codes of measurements, a dict of name -> value (or a list of them), for a measurements index."""
+        if self.code_type != 'measurements':
+            raise ValueError('A %s index has no codes for measurements' % self.code_type)
+        if isinstance(measurements, dict):
+            measurements = [measurements]
+        names = self.meta['code_names']
+        missing = set(name for m in measurements for name in names if name not in m)
+        if missing:
+            raise ValueError('Missing measurements: %s' % ', '.join(sorted(missing)))
+        codes = np.array([[m[name] for name in names] for m in measurements], dtype=np.float32)
+        return (codes - self.shift) / self.scale
+
+    def search(self, codes, k=5, nprobe=8):
+        """
+        The k nearest samples of each code, scanning the lists of the nprobe
+        nearest centroids. Returns positions (N, k) in the index (-1 where
+        the lists have less than k samples) and the distances.
+        """
+        codes = np.asarray(codes, dtype=np.float32).reshape(-1, self.codes.shape[1])
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argsort(squared_distances(codes, self.centroids), axis=1)[:, :nprobe]
+        positions = np.full((len(codes), k), -1, dtype=np.int64)
+        distances = np.full((len(codes), k), np.inf)
+        for i, code in enumerate(codes):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l+1]) for l in lists[i]])
+            dist = squared_distances(code[None], self.codes[rows])[0]
+            best = np.argsort(dist)[:k]
+            positions[i, :len(best)] = rows[best]
+            distances[i, :len(best)] = np.sqrt(dist[best])
+        return positions, distances
+
+    def neighbours(self, codes, k=5, nprobe=8):
+        """The k nearest samples of each code as lists of dicts (id, distance, params by label)."""
+        positions, distances = self.search(codes, k, nprobe)
+        result = []
+        for rowPositions, rowDistances in zip(positions, distances):
+            found = []
+            for position, distance in zip(rowPositions, rowDistances):
+                if position < 0:
+                    continue
+                found.append(OrderedDict([('id', int(self.ids[position])),
+                                          ('distance', float(distance)),
+                                          ('params', OrderedDict(zip(self.labels, self.params[position].tolist())))]))
+            result.append(found)
+        return result
+
+
+def build_index(data_dir, basis=None, dims=32, measurements=None, morph_model=None, n_lists=None, chunk_size=512):
+    """
+    HumanIndex of a training set directory, with pca codes of the first dims
+    components of basis (a PCABasis), or with measurement codes (a dict of
+    name -> array of one value per sample, in training set order).
+    """
+    import tables
+    from .morph_model import read_dataset
+    labels = read_dataset(data_dir, 0, 0)[0]
+    with tables.open_file(os.path.join(data_dir, 'y_train.hdf5'), 'r') as fi:
+        params = fi.root.data[:]
+    meta = OrderedDict([('labels', labels), ('data_dir', os.path.abspath(data_dir))])
+    if measurements is not None:
+        names = sorted(measurements)
+        codes = np.column_stack([np.asarray(measurements[name], dtype=np.float64) for name in names])
+        if len(codes) != len(params):
+            raise ValueError('%s measurements for %s samples' % (len(codes), len(params)))
+        meta['code_names'] = names
+        std = codes.std(axis=0)
+        return HumanIndex.build('measurements', codes, params, meta, n_lists,
+                                shift=codes.mean(axis=0).astype(np.float32),
+                                scale=np.where(std > 0, std, 1).astype(np.float32))
+
+    basis = basis.truncated(min(dims, basis.rank))
+    codes = pca_codes(os.path.join(data_dir, 'X_train.hdf5'), basis, chunk_size)
+    reference = None
+    if morph_model is not None:
+        reference = morph_model.coords(morph_model.reference_values(labels))[0]
+    meta['dims'] = basis.rank
+    return HumanIndex.build('pca', codes, params, meta, n_lists, mean=basis.mean.astype(np.float32),
+                            components=basis.components.astype(np.float32), reference=reference)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Nearest neighbour index over the humans of a training set.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    build = commands.add_parser('build', help='Build an index of a training set')
+    build.add_argument('data_dir', help='Directory with X_train.hdf5, y_train.hdf5 and metadata.json')
+    build.add_argument('-o', '--output', required=True, help='Index file (.npz)')
+    build.add_argument('--basis', default=None, help='PCA basis (.npz) for pca codes, see pca.py')
+    build.add_argument('--dims', type=int, default=32, help='Number of PCA components of the codes')
+    build.add_argument('--measurements', default=None,
+                       help='npz file of one array of values per measure (in training set order), for measurement codes, '
+                            'see wrap_mh/measure_dataset.py')
+    build.add_argument('--morph-model', default=None, help='Morph model (.npz), to query pca indexes with meshes')
+    build.add_argument('--lists', type=int, default=None, help='Number of inverted lists (default sqrt of the samples)')
+    query = commands.add_parser('query', help='Find the nearest humans of meshes or measurements')
+    query.add_argument('index', help='Index file (.npz)')
+    query.add_argument('queries', nargs='+', help='obj files, npy files of vertex deltas (N, nVerts, 3), '
+                                                  'or json files of measurements (name -> value, or a list of them)')
+    query.add_argument('-k', type=int, default=5, help='Number of neighbours')
+    query.add_argument('--nprobe', type=int, default=8, help='Number of inverted lists to scan')
+    query.add_argument('--max-distance', type=float, default=None, help='Only report neighbours this close')
+    options = parser.parse_args(argv)
+
+    if options.command == 'build':
+        from .pca import PCABasis
+        from .morph_model import MorphModel
+        if not options.basis and not options.measurements:
+            parser.error('build needs --basis or --measurements')
+        t = time.time()
+        if options.measurements:
+            npz = np.load(options.measurements)
+            index = build_index(options.data_dir, measurements=dict((name, npz[name]) for name in npz.files),
+                                n_lists=options.lists)
+        else:
+            morphModel = MorphModel.load(options.morph_model) if options.morph_model else None
+            index = build_index(options.data_dir, PCABasis.load(options.basis), options.dims,
+                                morph_model=morphModel, n_lists=options.lists)
+        index.save(options.output)
+        print('Indexed %s samples (%s codes of %s dims, %s lists) in %.1fs' % (
+            len(index), index.code_type, index.codes.shape[1], len(index.centroids), time.time() - t))
+        return 0
+
+    from .fit import read_obj_vertices
+    index = HumanIndex.load(options.index)
+    names = []
+    codes = []
+    for filename in options.queries:
+        base = os.path.splitext(os.path.basename(filename))[0]
+        if filename.endswith('.json'):
+            with open(filename) as fi:
+                measurements = json.load(fi)
+            codes.append(index.encode_measurements(measurements))
+            if isinstance(measurements, list):
+                names.extend('%s_%d' % (base, i) for i in range(len(measurements)))
+            else:
+                names.append(base)
+        elif filename.endswith('.npy'):
+            stack = index.encode_deltas(np.load(filename))
+            codes.append(stack)
+            names.extend('%s_%d' % (base, i) for i in range(len(stack)))
+        else:
+            codes.append(index.encode_coords(read_obj_vertices(filename)))
+            names.append(base)
+    t = time.time()
+    results = index.neighbours(np.concatenate(codes), options.k, options.nprobe)
+    print('%s queries in %.2fms' % (len(names), 1000 * (time.time() - t)), file=sys.stderr)
+    for name, found in zip(names, results):
+        if options.max_distance is not None:
+            found = [n for n in found if n['distance'] <= options.max_distance]
+        print(json.dumps(OrderedDict([('name', name), ('neighbours', found)])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
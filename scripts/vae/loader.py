@@ -0,0 +1,258 @@
+"""
+Batch loader for the HDF5 training set (X_train.hdf5 vertex deltas and
+y_train.hdf5 params), replacing keras HDF5Matrix:
+
+    - index based train/val/test splits, without cropping them to a multiple
+      of the batch size (the last batch of an epoch is smaller)
+    - shuffling of chunk aligned blocks: the order of the blocks and the rows
+      within a block are shuffled each epoch, but every block is one
+      contiguous read
+    - a background thread reads the next batches while the model trains
+    - the split is cached in RAM when it fits (max_cache_bytes)
+    - float16 data is converted to float32 on the fly
+
+Usage with keras:
+    dataset = HDF5Dataset(data_dir)
+    train, val, test = split_indices(len(dataset))
+    loader = BatchLoader(dataset, train, batch_size=32)
+    generator.fit_generator(loader.flow(), len(loader), ...)
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# default cache limit, in bytes (as float32)
+MAX_CACHE_BYTES = 2 << 30
+# split fractions of main.ipynb: 80% train, 10% val, 10% test
+SPLITS = (0.8, 0.1, 0.1)
+
+
+def split_indices(n, fractions=SPLITS):
+    """Contiguous index ranges (train, val, test, ...) of n samples."""
+    bounds = np.round(np.cumsum([0.0] + list(fractions)) / sum(fractions) * n).astype(np.int64)
+    return [np.arange(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+class HDF5Dataset(object):
+    """
+    The inputs (params, y_train.hdf5) and targets (vertex deltas,
+    X_train.hdf5) of a training set directory, as in main.ipynb the model
+    predicts the deltas from the params.
+    """
+
+    def __init__(self, data_dir, inputs='y_train.hdf5', targets='X_train.hdf5', node='data'):
+        import tables
+        self.files = [os.path.join(data_dir, inputs), os.path.join(data_dir, targets)]
+        self.node = node
+        self.shapes = []
+        self.dtypes = []
+        chunkRows = []
+        for filename in self.files:
+            with tables.open_file(filename, 'r') as fi:
+                data = fi.get_node('/' + node)
+                self.shapes.append(data.shape)
+                self.dtypes.append(data.dtype)
+                chunkRows.append(data.chunkshape[0] if data.chunkshape else 1)
+        if self.shapes[0][0] != self.shapes[1][0]:
+            raise ValueError('%s has %s rows but %s has %s' % (self.files[0], self.shapes[0][0],
+                                                              self.files[1], self.shapes[1][0]))
+        self.chunk_rows = max(chunkRows)
+
+    def __len__(self):
+        return self.shapes[0][0]
+
+    def row_bytes(self):
+        """Bytes of one sample (inputs and targets) as float32."""
+        return sum(4 * int(np.prod(shape[1:])) for shape in self.shapes)
+
+    def open(self):
+        """Open the files, returns the arrays (close with close())."""
+        import tables
+        handles = [tables.open_file(filename, 'r') for filename in self.files]
+        return handles, [h.get_node('/' + self.node) for h in handles]
+
+    @staticmethod
+    def close(handles):
+        for h in handles:
+            h.close()
+
+    @staticmethod
+    def read(arrays, start, stop):
+        """Rows start:stop of the arrays, as float32."""
+        return [_float32(a[start:stop]) for a in arrays]
+
+
+def _float32(data):
+    if data.dtype != np.float32 and data.dtype.kind == 'f':
+        return data.astype(np.float32)
+    return data
+
+
+class BatchLoader(object):
+    """
+    Batches (inputs, targets) of the samples indices of a dataset. Iterating
+    gives one epoch, flow() endless epochs (for keras fit_generator).
+    """
+
+    def __init__(self, dataset, indices=None, batch_size=32, shuffle=True, block_rows=None,
+                 prefetch=4, cache='auto', max_cache_bytes=MAX_CACHE_BYTES, seed=None):
+        self.dataset = dataset
+        self.indices = np.arange(len(dataset)) if indices is None else np.sort(np.asarray(indices))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # blocks are whole HDF5 chunks, so each block is read with the fewest chunk reads
+        chunkRows = dataset.chunk_rows
+        if block_rows is None:
+            block_rows = max(chunkRows, batch_size)
+        self.block_rows = int(np.ceil(float(block_rows) / chunkRows)) * chunkRows
+        self.prefetch = prefetch
+        self.rng = np.random.RandomState(seed)
+        if cache == 'auto':
+            cache = len(self.indices) * dataset.row_bytes() <= max_cache_bytes
+        self._cache = self._load_cache() if cache else None
+
+    def __len__(self):
+        """Number of batches per epoch."""
+        return int(np.ceil(float(len(self.indices)) / self.batch_size))
+
+    @property
+    def cached(self):
+        return self._cache is not None
+
+    def _load_cache(self):
+        handles, arrays = self.dataset.open()
+        try:
+            reads = [self.dataset.read(arrays, start, stop) for start, stop in self._runs(self.indices)]
+            if not reads:
+                # an empty split, keep the shapes of the rows
+                return self.dataset.read(arrays, 0, 0)
+            return [np.concatenate(parts) for parts in zip(*reads)]
+        finally:
+            self.dataset.close(handles)
+
+    @staticmethod
+    def _runs(indices):
+        """(start, stop) of the runs of consecutive indices."""
+        if not len(indices):
+            return []
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        starts = np.concatenate([[0], breaks])
+        stops = np.concatenate([breaks, [len(indices)]])
+        return [(indices[a], indices[b-1] + 1) for a, b in zip(starts, stops)]
+
+    def _blocks(self):
+        """The indices in chunk aligned blocks, in epoch order."""
+        blockIds = self.indices // self.block_rows
+        splits = np.flatnonzero(np.diff(blockIds)) + 1
+        blocks = np.split(np.arange(len(self.indices)), splits)
+        if self.shuffle:
+            self.rng.shuffle(blocks)
+            for block in blocks:
+                self.rng.shuffle(block)
+        return blocks
+
+    def _batches(self, arrays):
+        """Yield batches; positions index self.indices (and the cache)."""
+        if not len(self.indices):
+            return
+        pending = []
+        nPending = 0
+        for block in self._blocks():
+            if self._cache is not None:
+                pending.append([c[block] for c in self._cache])
+            else:
+                rows = self.indices[block]
+                start = rows.min()
+                data = self.dataset.read(arrays, start, rows.max() + 1)
+                pending.append([d[rows - start] for d in data])
+            nPending += len(block)
+            while nPending >= self.batch_size:
+                batch, pending, nPending = self._take(pending, nPending, self.batch_size)
+                yield batch
+        if nPending:
+            yield self._take(pending, nPending, nPending)[0]
+
+    @staticmethod
+    def _take(pending, nPending, n):
+        joined = [np.concatenate(parts) for parts in zip(*pending)] if len(pending) > 1 else pending[0]
+        batch = tuple(d[:n] for d in joined)
+        rest = [d[n:] for d in joined]
+        return batch, ([rest] if nPending > n else []), nPending - n
+
+    @staticmethod
+    def _put(out, item, stop):
+        """Put item in the queue, unless the consumer stopped. Returns whether it was put."""
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, out, stop):
+        handles, arrays = (None, None) if self._cache is not None else self.dataset.open()
+        try:
+            for batch in self._batches(arrays):
+                if not self._put(out, batch, stop):
+                    return
+            self._put(out, None, stop)
+        except Exception as e:
+            self._put(out, e, stop)
+        finally:
+            if handles:
+                self.dataset.close(handles)
+
+    def __iter__(self):
+        """One epoch of batches (inputs, targets), read in a background thread."""
+        if not self.prefetch:
+            handles, arrays = (None, None) if self._cache is not None else self.dataset.open()
+            try:
+                for batch in self._batches(arrays):
+                    yield batch
+            finally:
+                if handles:
+                    self.dataset.close(handles)
+            return
+
+        out = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(out, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch = out.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def flow(self):
+        """Endless batches, for keras fit_generator (steps_per_epoch=len(loader))."""
+        if not len(self.indices):
+            return
+        while True:
+            for batch in self:
+                yield batch
+
+
+def make_loaders(data_dir, batch_size=32, fractions=SPLITS, **kwargs):
+    """Train, validation and test loaders of a training set directory (only the train loader shuffles)."""
+    dataset = HDF5Dataset(data_dir)
+    loaders = OrderedDict()
+    for name, indices in zip(['train', 'val', 'test'], split_indices(len(dataset), fractions)):
+        options = dict(kwargs, shuffle=kwargs.get('shuffle', True) if name == 'train' else False)
+        loaders[name] = BatchLoader(dataset, indices, batch_size, **options)
+    return loaders
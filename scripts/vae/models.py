@@ -0,0 +1,229 @@
+"""
+Keras model builders for predicting vertex deltas from modifier params, and a
+benchmark comparing them.
+
+    - baseline: the model of main.ipynb, Dense(nb_targets) -> Dense(nb_targets)
+      -> Dense(nb_vertices*3), where every vertex depends on every hidden unit
+    - low rank: predicts the coefficients of a PCA basis (see pca.py) and
+      decodes them with a Dense layer initialized from the basis
+    - face group: one small decoder per face group of the base mesh, fed only
+      by the modifiers that can move its vertices (found from the target
+      vertex sets of a morph model, see morph_model.py)
+
+Usage:
+    python -m scripts.vae.models data_dir --basis basis.npz --morph-model morph_model.npz [-w name=weights.hdf5] [-o report.json]
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .morph_model import MorphModel, read_dataset, dataset_length, errors
+from .pca import PCABasis
+
+
+def _layers():
+    from keras import layers
+    try:
+        concatenate = layers.concatenate
+    except AttributeError:
+        # keras 1
+        def concatenate(tensors, axis=-1):
+            return layers.merge(tensors, mode='concat', concat_axis=axis)
+    return layers, concatenate
+
+
+def _dense_stack(x, units, alpha, name):
+    """Dense layers with LeakyReLU activations, as in main.ipynb."""
+    layers, _ = _layers()
+    for i, n in enumerate(units):
+        x = layers.Dense(n, name='%s_dense%d' % (name, i))(x)
+        x = layers.LeakyReLU(alpha)(x)
+    return x
+
+
+def build_baseline(nb_targets, nb_vertices, alpha=0.3):
+    """The generator of main.ipynb."""
+    from keras.models import Model
+    layers, _ = _layers()
+    x = inputs = layers.Input((nb_targets,), name='input')
+    x = _dense_stack(x, [nb_targets, nb_targets], alpha, 'hidden')
+    x = layers.Dense(nb_vertices * 3, name='vertices')(x)
+    x = layers.LeakyReLU(alpha)(x)
+    x = layers.Reshape((nb_vertices, 3), name='output')(x)
+    return Model(inputs, x)
+
+
+def build_low_rank(nb_targets, basis, hidden_units=None, trainable_basis=True, alpha=0.3):
+    """
+    Predict the coefficients of a PCABasis and decode them to vertex deltas
+    with a linear layer initialized to the basis (components and mean).
+    """
+    from keras.models import Model
+    layers, _ = _layers()
+    nb_vertices = len(basis.mean) // 3
+    if hidden_units is None:
+        hidden_units = [nb_targets, nb_targets]
+    x = inputs = layers.Input((nb_targets,), name='input')
+    x = _dense_stack(x, hidden_units, alpha, 'hidden')
+    x = layers.Dense(basis.rank, name='coefficients')(x)
+    decoder = layers.Dense(nb_vertices * 3, name='basis', trainable=trainable_basis,
+                           weights=[basis.components.astype(np.float32), basis.mean.astype(np.float32)])
+    x = decoder(x)
+    x = layers.Reshape((nb_vertices, 3), name='output')(x)
+    return Model(inputs, x)
+
+
+def face_group_partition(morph_model, names=None, min_vertices=64):
+    """
+    Partition the vertices by face group, for build_face_group_decoder().
+    Returns a list of (group name, vertex indices, input indices), where the
+    inputs are the param columns (names, default: sorted modifier names) of
+    the modifiers that can move the vertices of the group. Face groups with
+    less than min_vertices vertices, and loose vertices, are merged into one
+    group.
+    """
+    if morph_model.vertex_group is None:
+        raise ValueError('Morph model has no face groups, export it again')
+    if names is None:
+        names = sorted(morph_model.modifier_names)
+    columns = [morph_model.modifier_names.index(name) for name in names]
+    # (nInputs, nVerts) vertices that each input can move
+    moves = np.array([morph_model.modifier_vertices(j) for j in columns])
+
+    vertexGroup = morph_model.vertex_group.astype(np.int64)
+    counts = np.bincount(vertexGroup[vertexGroup >= 0], minlength=len(morph_model.face_groups))
+    partition = []
+    rest = np.zeros(len(vertexGroup), dtype=bool)
+    rest[vertexGroup < 0] = True
+    for g, name in enumerate(morph_model.face_groups):
+        verts = np.flatnonzero(vertexGroup == g)
+        if not len(verts):
+            continue
+        if counts[g] < min_vertices:
+            rest[verts] = True
+            continue
+        partition.append((name, verts, np.flatnonzero(moves[:, verts].any(axis=1))))
+    if rest.any():
+        verts = np.flatnonzero(rest)
+        partition.append(('rest', verts, np.flatnonzero(moves[:, verts].any(axis=1))))
+    return partition
+
+
+def _reorder_vertices(x, order):
+    """Gather (batch, vertices, 3) along the vertex axis."""
+    from keras import backend as K
+    x = K.permute_dimensions(x, (1, 0, 2))
+    return K.permute_dimensions(K.gather(x, order), (1, 0, 2))
+
+
+def build_face_group_decoder(nb_targets, partition, hidden_units=None, alpha=0.3, reorder=True):
+    """
+    One decoder per group of a partition (see face_group_partition()). Each
+    decoder sees only the inputs of its group, selected by a fixed one-hot
+    Dense layer. hidden_units(nInputs, nVerts) gives the hidden layer sizes
+    of a decoder (default: two layers of the number of inputs).
+
+    The group outputs are concatenated, and reordered to the vertex order of
+    the mesh with a Lambda layer, unless reorder is False (the output is then
+    in the order of np.concatenate of the partition vertices, eg. for
+    keras-js, which has no Lambda layer).
+    """
+    from keras.models import Model
+    layers, concatenate = _layers()
+    if hidden_units is None:
+        hidden_units = lambda nInputs, nVerts: [nInputs, nInputs]
+    inputs = layers.Input((nb_targets,), name='input')
+    outputs = []
+    for i, (name, verts, inputIdx) in enumerate(partition):
+        select = np.zeros((nb_targets, len(inputIdx)), dtype=np.float32)
+        select[inputIdx, np.arange(len(inputIdx))] = 1
+        x = layers.Dense(len(inputIdx), trainable=False, name='select%d' % i,
+                         weights=[select, np.zeros(len(inputIdx), dtype=np.float32)])(inputs)
+        x = _dense_stack(x, hidden_units(len(inputIdx), len(verts)), alpha, 'group%d' % i)
+        x = layers.Dense(len(verts) * 3, name='group%d_vertices' % i)(x)
+        outputs.append(layers.Reshape((len(verts), 3))(x))
+    x = concatenate(outputs, axis=1) if len(outputs) > 1 else outputs[0]
+    if reorder:
+        order = np.argsort(np.concatenate([verts for _, verts, _ in partition]))
+        x = layers.Lambda(_reorder_vertices, arguments={'order': order.tolist()}, name='output')(x)
+    return Model(inputs, x)
+
+
+def count_params(model):
+    """Trainable and total parameter counts of a keras model."""
+    from keras import backend as K
+    trainable = sum(int(np.prod(K.int_shape(w))) for w in model.trainable_weights)
+    return trainable, int(model.count_params())
+
+
+def benchmark(models, data_dir, n_samples=256, batch_size=32, repeats=3):
+    """
+    Parameter count, CPU inference latency (per batch and for one sample) and
+    error of keras models (a dict of name -> model) on the last n_samples of
+    a training set. Returns the report as a dict.
+    """
+    total = dataset_length(data_dir)
+    _, X, y = read_dataset(data_dir, max(0, total - n_samples), total)
+    report = OrderedDict()
+    for name, model in models.items():
+        model.predict(y[:batch_size], batch_size=batch_size)  # warm up
+        batchTimes = []
+        for _ in range(repeats):
+            t = time.time()
+            pred = model.predict(y, batch_size=batch_size)
+            batchTimes.append((time.time() - t) / max(1, len(y) // batch_size))
+        t = time.time()
+        for i in range(min(len(y), 32)):
+            model.predict(y[i:i+1], batch_size=1)
+        trainable, params = count_params(model)
+        result = OrderedDict([('parameters', params),
+                              ('trainable_parameters', trainable),
+                              ('batch_latency', min(batchTimes)),
+                              ('sample_latency', (time.time() - t) / min(len(y), 32))])
+        result.update(errors(pred.reshape(X.shape), X))
+        report[name] = result
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the decoder architectures and benchmark them.')
+    parser.add_argument('data_dir', help='Directory with X_train.hdf5, y_train.hdf5 and metadata.json')
+    parser.add_argument('--basis', default=None, help='PCA basis (.npz) for the low rank model')
+    parser.add_argument('--morph-model', default=None, help='Morph model (.npz) for the face group model')
+    parser.add_argument('--min-vertices', type=int, default=64, help='Merge smaller face groups')
+    parser.add_argument('-w', '--weights', action='append', default=[],
+                        help='name=weights.hdf5, trained weights for model name (baseline, low_rank, face_group)')
+    parser.add_argument('-n', '--samples', type=int, default=256)
+    parser.add_argument('-b', '--batch-size', type=int, default=32)
+    parser.add_argument('-o', '--output', default=None, help='Write the report to this json file')
+    options = parser.parse_args(argv)
+
+    names, X, _ = read_dataset(options.data_dir, 0, 1)
+    models = OrderedDict([('baseline', build_baseline(len(names), X.shape[1]))])
+    if options.basis:
+        models['low_rank'] = build_low_rank(len(names), PCABasis.load(options.basis))
+    if options.morph_model:
+        partition = face_group_partition(MorphModel.load(options.morph_model), names, options.min_vertices)
+        models['face_group'] = build_face_group_decoder(len(names), partition)
+    for spec in options.weights:
+        name, filename = spec.split('=', 1)
+        models[name].load_weights(filename)
+
+    report = benchmark(models, options.data_dir, options.samples, options.batch_size)
+    keys = list(next(iter(report.values())).keys())
+    print('%-22s' % '' + ''.join('%16s' % name for name in report))
+    for key in keys:
+        print('%-22s' % key + ''.join('%16.6g' % report[name][key] for name in report))
+    if options.output:
+        with open(options.output, 'w') as fo:
+            json.dump(report, fo, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,448 @@
+"""
+Exact sparse linear morph model of the makehuman modeling modifiers.
+
+makehuman makes a human by adding weighted targets to the base mesh
+(human.applyAllTargets()). The weight of a target is the product of its
+factors: the macro values derived from the macro modifiers (maleVal, babyVal,
+...) and the left/right/center value of the modifier that owns the target. A
+morph model stores this weight logic together with only the targets that the
+modeling modifiers reference, so humans can be made with numpy alone, exactly
+instead of approximately like the keras model.
+
+A morph model file (.npz, written by wrap_mh/morph_export.py) has:
+    - base: (nVerts, 3) float32 rest coordinates of the base mesh
+    - offsets: (nTargets + 1,) int64, the entries of target t are offsets[t]:offsets[t+1]
+    - verts: (nEntries,) uint16 (uint32 for big meshes) vertex indices
+    - data: (nEntries, 3) int16 quantized vertex offsets
+    - scale: (nTargets,) float64, the offsets of target t are data * scale[t]
+    - meta: utf-8 encoded json with the target paths and factors, the modifiers
+      and the face group names
+    - vertex_group: (nVerts,) int16 face group of each vertex (-1 for loose
+      vertices), optional
+
+Targets compiled by makehuman are stored in thousandths, which int16 data with
+a scale of 1e-3 holds without loss. Other targets get the scale that fits
+their largest offset in int16.
+
+The three ethnic values are normalized to sum to 1. makehuman normalizes them
+one at a time while modifiers are set, so its result depends on the order in
+which they were set, unless the values already sum to 1.
+
+Usage:
+    python -m scripts.vae.morph_model model.npz data_dir [-k keras_model.hdf5] [-n 256] [-o report.json]
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+MORPH_MODEL_VERSION = 1
+# step of the targets compiled by makehuman (int16 thousandths)
+TARGET_STEP = 1e-3
+INT16_MAX = 32767
+ETHNICS = ['african', 'asian', 'caucasian']
+
+
+def _age_vals(age):
+    """Like human._setAgeVals()."""
+    young = np.maximum(0.0, (age - 0.1875) * 3.2)
+    old = np.maximum(0.0, age * 2 - 1)
+    isYoung = age < 0.5
+    return {'baby': np.where(isYoung, np.maximum(0.0, 1 - age * 5.333), 0.0),
+            'child': np.where(isYoung, np.maximum(0.0, np.minimum(1.0, 5.333 * age) - young), 0.0),
+            'young': np.where(isYoung, young, 1 - old),
+            'old': np.where(isYoung, 0.0, old)}
+
+
+def _gender_vals(gender):
+    return {'male': gender, 'female': 1 - gender}
+
+
+def _three_vals(low, average, high):
+    """Like human._setWeightVals() and the other min/average/max macro values."""
+    def vals(value):
+        highVal = np.maximum(0.0, value * 2 - 1)
+        lowVal = np.maximum(0.0, 1 - value * 2)
+        return {low: lowVal, average: 1 - (highVal + lowVal), high: highVal}
+    return vals
+
+# macro variable (the lower case name of the macro modifier variable) -> function
+# of its value returning the macro values
+MACRO_VALUES = OrderedDict([
+    ('gender', _gender_vals),
+    ('age', _age_vals),
+    ('muscle', _three_vals('minmuscle', 'averagemuscle', 'maxmuscle')),
+    ('weight', _three_vals('minweight', 'averageweight', 'maxweight')),
+    ('height', _three_vals('minheight', 'averageheight', 'maxheight')),
+    ('breastsize', _three_vals('mincup', 'averagecup', 'maxcup')),
+    ('breastfirmness', _three_vals('minfirmness', 'averagefirmness', 'maxfirmness')),
+    ('bodyproportions', _three_vals('uncommonproportions', 'regularproportions', 'idealproportions')),
+])
+
+# values of the macro variables at which their macro values have a kink
+MACRO_KINKS = OrderedDict((var, [0.5]) for var in MACRO_VALUES)
+MACRO_KINKS['gender'] = []
+MACRO_KINKS['age'] = [0.1875, 0.5]
+
+
+def quantize_offsets(data):
+    """
+    Quantize target offsets (n, 3) to int16. Returns the quantized offsets and
+    their scale. Offsets in thousandths (compiled targets) are kept exactly.
+    """
+    data = np.asarray(data)
+    amax = float(np.abs(data).max()) if data.size else 0.0
+    quantized = np.round(data / TARGET_STEP)
+    if amax <= INT16_MAX * TARGET_STEP and \
+            np.array_equal((quantized * TARGET_STEP).astype(data.dtype), data):
+        return quantized.astype(np.int16), TARGET_STEP
+    scale = amax / INT16_MAX if amax else 1.0
+    return np.round(data / scale).astype(np.int16), scale
+
+
+class MorphModel(object):
+    """
+    The modifier -> target weight logic of makehuman and its quantized sparse
+    targets. Modifier values are given as a dict of modifier values, a list
+    of them, or an array (N, nModifiers) in the order of modifier_names.
+    """
+
+    def __init__(self, base, offsets, verts, data, scale, meta, vertex_group=None):
+        self.base = np.asarray(base, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.verts = np.asarray(verts)
+        self.data = np.asarray(data, dtype=np.int16)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.meta = meta
+        self.vertex_group = None if vertex_group is None else np.asarray(vertex_group, dtype=np.int16)
+        self.face_groups = meta.get('face_groups', [])
+        if meta.get('version') != MORPH_MODEL_VERSION:
+            raise ValueError('Unsupported morph model version %s' % meta.get('version'))
+
+        self.target_paths = [t['path'] for t in meta['targets']]
+        self.modifiers = meta['modifiers']
+        self.modifier_names = [m['name'] for m in self.modifiers]
+        self._modifier_index = dict((name, i) for i, name in enumerate(self.modifier_names))
+        self.mins = np.array([m['min'] for m in self.modifiers], dtype=np.float64)
+        self.maxs = np.array([m['max'] for m in self.modifiers], dtype=np.float64)
+        self.defaults = np.array([m['default'] for m in self.modifiers], dtype=np.float64)
+        self._build_factors()
+
+    def _build_factors(self):
+        """Columns of the factor matrix, and the factor columns of each target."""
+        names = [None]  # column 0 is the constant 1, for padding
+        for func in MACRO_VALUES.values():
+            names.extend(sorted(func(0.5).keys()))
+        names.extend(ETHNICS)
+        for m in self.modifiers:
+            if m['type'] == 'universal':
+                names.extend(m[side] for side in ('left', 'center', 'right') if m[side])
+            elif m['group'] not in names:
+                names.append(m['group'])
+        self.factor_names = names
+        self._factor_column = dict((name, i) for i, name in enumerate(names))
+
+        factors = [t['factors'] for t in self.meta['targets']]
+        index = np.zeros((len(factors), max([len(f) for f in factors] + [1])), dtype=np.intp)
+        for t, tfactors in enumerate(factors):
+            for k, factor in enumerate(tfactors):
+                if factor not in self._factor_column:
+                    raise ValueError('Target %s depends on unknown factor %s' % (self.target_paths[t], factor))
+                index[t, k] = self._factor_column[factor]
+        self._factor_index = index
+
+    @property
+    def nTargets(self):
+        return len(self.target_paths)
+
+    @classmethod
+    def from_targets(cls, base, targets, modifiers, face_groups=None, vertex_group=None):
+        """
+        Build a morph model from targets, a list of (path, factors, verts, data),
+        and modifier definitions (see wrap_mh/morph_export.py).
+        """
+        offsets = np.zeros(len(targets) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(verts) for _, _, verts, _ in targets])
+        vdtype = np.uint16 if len(base) <= 0xffff else np.uint32
+        verts = np.empty(offsets[-1], dtype=vdtype)
+        data = np.empty((offsets[-1], 3), dtype=np.int16)
+        scale = np.empty(len(targets), dtype=np.float64)
+        for t, (_, _, tverts, tdata) in enumerate(targets):
+            verts[offsets[t]:offsets[t+1]] = tverts
+            data[offsets[t]:offsets[t+1]], scale[t] = quantize_offsets(tdata)
+        meta = {'version': MORPH_MODEL_VERSION,
+                'targets': [{'path': path, 'factors': list(factors)} for path, factors, _, _ in targets],
+                'modifiers': modifiers,
+                'face_groups': list(face_groups or [])}
+        return cls(base, offsets, verts, data, scale, meta, vertex_group)
+
+    def save(self, filename, compress=True):
+        meta = np.frombuffer(json.dumps(self.meta).encode('utf-8'), dtype=np.uint8)
+        arrays = dict(base=self.base, offsets=self.offsets, verts=self.verts,
+                      data=self.data, scale=self.scale, meta=meta)
+        if self.vertex_group is not None:
+            arrays['vertex_group'] = self.vertex_group
+        savez = np.savez_compressed if compress else np.savez
+        savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        npz = np.load(filename)
+        meta = json.loads(npz['meta'].tobytes().decode('utf-8'))
+        vertexGroup = npz['vertex_group'] if 'vertex_group' in npz.files else None
+        return cls(npz['base'], npz['offsets'], npz['verts'], npz['data'], npz['scale'], meta, vertexGroup)
+
+    def values_array(self, values, clip=True):
+        """
+        Modifier values as a clamped array (N, nModifiers). Modifiers missing
+        from a dict get their default value.
+        """
+        if isinstance(values, dict):
+            values = [values]
+        if len(values) and isinstance(values[0], dict):
+            result = np.tile(self.defaults, (len(values), 1))
+            for row, vals in zip(result, values):
+                for name, value in vals.items():
+                    row[self._modifier_index[name]] = value
+        else:
+            result = np.array(values, dtype=np.float64, ndmin=2)
+        return np.clip(result, self.mins, self.maxs) if clip else result
+
+    def params_to_values(self, params, names=None):
+        """
+        Modifier values (N, nModifiers) from params in [0, 1], as in the
+        training data: value = param * (max - min) + min. names is the
+        modifier of each param column (default: sorted modifier names).
+        """
+        params = np.array(params, dtype=np.float64, ndmin=2)
+        if names is None:
+            names = sorted(self.modifier_names)
+        index = [self._modifier_index[name] for name in names]
+        values = np.tile(self.defaults, (len(params), 1))
+        values[:, index] = params * (self.maxs[index] - self.mins[index]) + self.mins[index]
+        return values
+
+    def reference_values(self, names=None):
+        """The values of the reference human of the training data (all params 0.5)."""
+        nParams = len(names) if names is not None else len(self.modifier_names)
+        return self.params_to_values(np.full((1, nParams), 0.5), names)
+
+    def factors(self, values, clip=True):
+        """
+        Factor values (N, nFactors) for modifier values, see factor_names.
+        Unclipped values extend the factors linearly (for derivatives at the
+        bounds).
+        """
+        values = self.values_array(values, clip)
+        col = self._factor_column
+        result = np.zeros((len(values), len(self.factor_names)))
+        result[:, 0] = 1.0
+
+        macro = dict((var, np.full(len(values), 0.5)) for var in MACRO_VALUES)
+        ethnic = dict((var, np.full(len(values), 1.0 / 3)) for var in ETHNICS)
+        for j, m in enumerate(self.modifiers):
+            value = values[:, j]
+            if m['type'] == 'universal':
+                if m['left']:
+                    result[:, col[m['left']]] = -np.minimum(value, 0.0)
+                if m['center']:
+                    result[:, col[m['center']]] = 1.0 - np.abs(value)
+                result[:, col[m['right']]] = np.maximum(0.0, value)
+            else:
+                result[:, col[m['group']]] = 1.0
+                if m['variable'] in ETHNICS:
+                    ethnic[m['variable']] = value
+                else:
+                    macro[m['variable']] = value
+
+        for var, func in MACRO_VALUES.items():
+            for name, val in func(macro[var]).items():
+                result[:, col[name]] = val
+        total = sum(ethnic.values())
+        for name in ETHNICS:
+            # all ethnic values 0 is reset to the default, like human._setEthnicVals()
+            result[:, col[name]] = np.where(total > 0, ethnic[name] / np.where(total > 0, total, 1), 1.0 / 3)
+        return result
+
+    def target_weights(self, values):
+        """Target weights (N, nTargets), like human.targetsDetailStack."""
+        return np.prod(self.factors(values)[:, self._factor_index], axis=2)
+
+    def target_offsets(self, t):
+        """Vertex indices and offsets of target t."""
+        s = slice(self.offsets[t], self.offsets[t+1])
+        return self.verts[s], self.data[s] * self.scale[t]
+
+    def modifier_factors(self, j):
+        """Names of the (non constant) factors that modifier j sets."""
+        m = self.modifiers[j]
+        if m['type'] == 'universal':
+            return [m[side] for side in ('left', 'center', 'right') if m[side]]
+        elif m['variable'] in ETHNICS:
+            # the ethnic values are normalized together
+            return list(ETHNICS)
+        return list(MACRO_VALUES[m['variable']](0.5).keys())
+
+    def modifier_kinks(self, j):
+        """Values of modifier j (inside its range) at which the factors it sets have a kink."""
+        m = self.modifiers[j]
+        if m['type'] == 'universal':
+            kinks = [0.0]
+        elif m['variable'] in ETHNICS:
+            kinks = []
+        else:
+            kinks = MACRO_KINKS[m['variable']]
+        return [k for k in kinks if m['min'] < k < m['max']]
+
+    def modifier_targets(self, j):
+        """Indices of the targets whose weight depends on modifier j."""
+        columns = [self._factor_column[name] for name in self.modifier_factors(j)]
+        return np.flatnonzero(np.isin(self._factor_index, columns).any(axis=1))
+
+    def modifier_vertices(self, j):
+        """Boolean mask of the vertices that modifier j can move."""
+        mask = np.zeros(len(self.base), dtype=bool)
+        for t in self.modifier_targets(j):
+            mask[self.verts[self.offsets[t]:self.offsets[t+1]]] = True
+        return mask
+
+    def coords(self, values):
+        """Mesh coordinates (N, nVerts, 3) of humans with modifier values."""
+        weights = self.target_weights(values)
+        result = np.empty((len(weights),) + self.base.shape, dtype=np.float32)
+        result[:] = self.base
+        for t in np.flatnonzero(weights.any(axis=0)):
+            verts, offsets = self.target_offsets(t)
+            humans = np.flatnonzero(weights[:, t])
+            # accumulate in float32 per target, like algos3d.Target.apply()
+            result[humans[:, None], verts] += weights[humans, t, None, None] * offsets
+        return result
+
+    def deltas(self, values, reference=None):
+        """
+        Coordinates minus those of a reference human (default: the
+        reference of the training data), as in X_train.hdf5.
+        """
+        if reference is None:
+            reference = self.reference_values()
+        return self.coords(values) - self.coords(reference)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.base, self.offsets, self.verts, self.data, self.scale))
+
+
+def read_dataset(data_dir, start=None, stop=None):
+    """
+    Modifier names (the param columns), X (vertex deltas) and y (params) of
+    a training set made by "Make random outputs for a VAE (to hdf).ipynb".
+    """
+    import tables
+    with open(os.path.join(data_dir, 'metadata.json'), 'rb') as fi:
+        metadata = json.load(fi)
+    names = [name for _, name in sorted((int(k), v) for k, v in metadata['target_dict'].items())]
+    with tables.open_file(os.path.join(data_dir, 'X_train.hdf5'), 'r') as fi:
+        X = fi.root.data[start:stop]
+    with tables.open_file(os.path.join(data_dir, 'y_train.hdf5'), 'r') as fi:
+        y = fi.root.data[start:stop]
+    return names, X, y
+
+
+def dataset_length(data_dir):
+    import tables
+    with tables.open_file(os.path.join(data_dir, 'y_train.hdf5'), 'r') as fi:
+        return len(fi.root.data)
+
+
+def errors(pred, X):
+    """Error statistics of predicted vertex deltas."""
+    err = np.abs(np.asarray(pred, dtype=np.float64) - X)
+    dist = np.sqrt((err ** 2).sum(axis=-1))
+    return OrderedDict([('mae', float(err.mean())),
+                        ('max_error', float(err.max())),
+                        ('mean_vertex_error', float(dist.mean())),
+                        ('p99_vertex_error', float(np.percentile(dist, 99)))])
+
+
+def benchmark(model_file, data_dir, keras_model_file=None, n_samples=256, batch_size=32):
+    """
+    Compare the size, load time, evaluation time and error of a morph model
+    (and optionally a keras model) on the last n_samples of a training set
+    (the test split of main.ipynb). Returns the report as a dict.
+    """
+    total = dataset_length(data_dir)
+    names, X, y = read_dataset(data_dir, max(0, total - n_samples), total)
+    report = OrderedDict([('dataset', OrderedDict([('path', os.path.abspath(data_dir)),
+                                                   ('samples', len(X)),
+                                                   ('vertices', X.shape[1]),
+                                                   ('mean_abs_delta', float(np.abs(X).mean()))]))])
+
+    t = time.time()
+    model = MorphModel.load(model_file)
+    loadTime = time.time() - t
+    t = time.time()
+    reference = model.coords(model.reference_values(names))
+    pred = np.concatenate([model.coords(model.params_to_values(y[i:i+batch_size], names)) - reference
+                           for i in range(0, len(y), batch_size)])
+    evalTime = time.time() - t
+    result = OrderedDict([('file_size', os.path.getsize(model_file)),
+                          ('memory_size', model.nbytes()),
+                          ('targets', model.nTargets),
+                          ('load_time', loadTime),
+                          ('time_per_sample', evalTime / len(y))])
+    result.update(errors(pred, X))
+    report['morph_model'] = result
+
+    if keras_model_file:
+        import keras
+        t = time.time()
+        keras_model = keras.models.load_model(keras_model_file)
+        loadTime = time.time() - t
+        t = time.time()
+        pred = keras_model.predict(y, batch_size=batch_size).reshape(X.shape)
+        evalTime = time.time() - t
+        result = OrderedDict([('file_size', os.path.getsize(keras_model_file)),
+                              ('parameters', int(keras_model.count_params())),
+                              ('load_time', loadTime),
+                              ('time_per_sample', evalTime / len(y))])
+        result.update(errors(pred, X))
+        report['keras'] = result
+    return report
+
+
+def print_report(report):
+    print('dataset: %(path)s, %(samples)s samples, mean |delta| %(mean_abs_delta).5f' % report['dataset'])
+    models = [name for name in report if name != 'dataset']
+    keys = []
+    for name in models:
+        keys.extend(k for k in report[name] if k not in keys)
+    print('%-20s' % '' + ''.join('%16s' % name for name in models))
+    for key in keys:
+        row = [report[name].get(key) for name in models]
+        print('%-20s' % key + ''.join('%16s' % ('-' if v is None else '%.6g' % v) for v in row))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark a morph model (and a keras model) on a training set.')
+    parser.add_argument('model', help='Morph model file (.npz)')
+    parser.add_argument('data_dir', help='Directory with X_train.hdf5, y_train.hdf5 and metadata.json')
+    parser.add_argument('-k', '--keras-model', default=None, help='Keras model file to compare with')
+    parser.add_argument('-n', '--samples', type=int, default=256, help='Number of samples, from the end of the data')
+    parser.add_argument('-b', '--batch-size', type=int, default=32)
+    parser.add_argument('-o', '--output', default=None, help='Write the report to this json file')
+    options = parser.parse_args(argv)
+
+    report = benchmark(options.model, options.data_dir, options.keras_model, options.samples, options.batch_size)
+    print_report(report)
+    if options.output:
+        with open(options.output, 'w') as fo:
+            json.dump(report, fo, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
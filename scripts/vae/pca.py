@@ -0,0 +1,262 @@
+"""
+PCA basis of the vertex deltas of a training set, fitted by streaming the
+HDF5 file in chunks, so the data never has to fit in memory.
+
+Models can predict the K coefficients of the basis instead of all vertex
+deltas: deltas = mean + coefficients . components (see PCABasis).
+
+Two methods:
+    - randomized: randomized SVD (Halko et al.) of the centered data, with
+      power iterations. Each power iteration reads the data twice more.
+    - incremental: incremental PCA (Ross et al., as sklearn IncrementalPCA),
+      one pass over the data but an SVD of (K + chunk_size) rows per chunk.
+
+Usage:
+    python -m scripts.vae.pca X_train.hdf5 -k 128 -o basis.npz [--method incremental] [-r report.json] [-c coefficients.hdf5]
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+
+def iter_chunks(filename, chunk_size=512, start=0, stop=None, node='data'):
+    """Yield (offset, rows) of an HDF5 array, rows flattened to (n, nFeatures) float64."""
+    import tables
+    with tables.open_file(filename, 'r') as fi:
+        data = fi.get_node('/' + node)
+        stop = len(data) if stop is None else min(stop, len(data))
+        for i in range(start, stop, chunk_size):
+            rows = data[i:min(i + chunk_size, stop)]
+            yield i - start, rows.reshape(len(rows), -1).astype(np.float64)
+
+
+def _merge_stats(n, mean, m2, rows):
+    """Merge the count, mean and sum of squared deviations of rows (Chan et al.)."""
+    nRows = len(rows)
+    rowsMean = rows.mean(axis=0)
+    rowsM2 = ((rows - rowsMean) ** 2).sum(axis=0)
+    if n == 0:
+        return nRows, rowsMean, rowsM2
+    total = n + nRows
+    delta = rowsMean - mean
+    return total, mean + delta * nRows / total, m2 + rowsM2 + delta ** 2 * n * nRows / total
+
+
+def column_stats(filename, chunk_size=512, start=0, stop=None):
+    """Number of samples, mean and variance of each feature."""
+    n, mean, m2 = 0, None, None
+    for _, rows in iter_chunks(filename, chunk_size, start, stop):
+        n, mean, m2 = _merge_stats(n, mean, m2, rows)
+    return n, mean, m2 / max(n - 1, 1)
+
+
+def _orthonormalize(a):
+    return np.linalg.qr(a)[0]
+
+
+def _flip_signs(components):
+    """Make the largest coefficient of each component positive, for reproducible bases."""
+    signs = np.sign(components[np.arange(len(components)), np.abs(components).argmax(axis=1)])
+    signs[signs == 0] = 1
+    return components * signs[:, None]
+
+
+def randomized_basis(filename, rank, chunk_size=512, oversamples=10, power_iterations=2,
+                     start=0, stop=None, seed=0):
+    """Fit a PCABasis of rank components by a streamed randomized SVD."""
+    n, mean, var = column_stats(filename, chunk_size, start, stop)
+    size = min(rank + oversamples, n, len(mean))
+    omega = np.random.RandomState(seed).standard_normal((len(mean), size))
+
+    def times(right):
+        """(X - mean) . right, streamed."""
+        result = np.empty((n, right.shape[1]))
+        for i, rows in iter_chunks(filename, chunk_size, start, stop):
+            result[i:i+len(rows)] = (rows - mean).dot(right)
+        return result
+
+    def transposed_times(left):
+        """(X - mean).T . left, streamed."""
+        result = np.zeros((len(mean), left.shape[1]))
+        for i, rows in iter_chunks(filename, chunk_size, start, stop):
+            result += (rows - mean).T.dot(left[i:i+len(rows)])
+        return result
+
+    q = _orthonormalize(times(omega))
+    for _ in range(power_iterations):
+        q = _orthonormalize(times(_orthonormalize(transposed_times(q))))
+    b = transposed_times(q).T
+    _, s, vt = np.linalg.svd(b, full_matrices=False)
+    return PCABasis(mean, _flip_signs(vt[:rank]), s[:rank], n, var.sum())
+
+
+def incremental_basis(filename, rank, chunk_size=512, start=0, stop=None):
+    """Fit a PCABasis of rank components by incremental PCA, in one pass."""
+    n, mean, m2 = 0, None, None
+    s = vt = None
+    for _, rows in iter_chunks(filename, chunk_size, start, stop):
+        nSeen, meanSeen = n, mean
+        n, mean, m2 = _merge_stats(n, mean, m2, rows)
+        if vt is None:
+            stacked = rows - mean
+        else:
+            rowsMean = rows.mean(axis=0)
+            correction = np.sqrt(float(nSeen * len(rows)) / n) * (meanSeen - rowsMean)
+            stacked = np.vstack([s[:, None] * vt, rows - rowsMean, correction])
+        _, s, vt = np.linalg.svd(stacked, full_matrices=False)
+        s, vt = s[:rank], vt[:rank]
+    return PCABasis(mean, _flip_signs(vt), s, n, (m2 / max(n - 1, 1)).sum())
+
+
+class PCABasis(object):
+    """
+    Mean and principal components (rank, nFeatures) of flattened vertex
+    deltas (nVerts * 3 features), ordered by explained variance.
+    """
+
+    def __init__(self, mean, components, singular_values, n_samples, total_variance):
+        self.mean = np.asarray(mean)
+        self.components = np.asarray(components)
+        self.singular_values = np.asarray(singular_values)
+        self.n_samples = int(n_samples)
+        self.total_variance = float(total_variance)
+
+    @property
+    def rank(self):
+        return len(self.components)
+
+    @property
+    def explained_variance(self):
+        return self.singular_values ** 2 / max(self.n_samples - 1, 1)
+
+    @property
+    def explained_variance_ratio(self):
+        return self.explained_variance / self.total_variance
+
+    def truncated(self, rank):
+        """The basis of the first rank components."""
+        return PCABasis(self.mean, self.components[:rank], self.singular_values[:rank],
+                        self.n_samples, self.total_variance)
+
+    def transform(self, X):
+        """Coefficients (N, rank) of vertex deltas (N, nVerts, 3) or (N, nFeatures)."""
+        X = np.asarray(X)
+        return (X.reshape(len(X), -1) - self.mean).dot(self.components.T)
+
+    def inverse_transform(self, coefficients):
+        """Vertex deltas (N, nVerts, 3) of coefficients (N, rank)."""
+        X = np.asarray(coefficients).dot(self.components[:np.shape(coefficients)[-1]]) + self.mean
+        return X.reshape(len(X), -1, 3)
+
+    def save(self, filename, dtype=np.float32):
+        np.savez(filename, mean=self.mean.astype(dtype), components=self.components.astype(dtype),
+                 singular_values=self.singular_values, n_samples=self.n_samples,
+                 total_variance=self.total_variance)
+
+    @classmethod
+    def load(cls, filename):
+        npz = np.load(filename)
+        return cls(npz['mean'], npz['components'], npz['singular_values'],
+                   npz['n_samples'], npz['total_variance'])
+
+
+def evaluate(basis, filename, ranks=None, chunk_size=512, start=0, stop=None):
+    """
+    Reconstruction error of the data with the first r components, for each r
+    in ranks (default: the full rank). Returns a dict of mae and max error
+    per rank, and the mean and max error of each vertex at the full rank.
+    """
+    for r in ranks or []:
+        if not 1 <= r <= basis.rank:
+            raise ValueError('Rank %s is not in 1..%s' % (r, basis.rank))
+    ranks = sorted(set(ranks or []) | set([basis.rank]))
+    absSum = dict((r, 0.0) for r in ranks)
+    absMax = dict((r, 0.0) for r in ranks)
+    vertexSum = vertexMax = None
+    n = 0
+    for _, rows in iter_chunks(filename, chunk_size, start, stop):
+        coefficients = basis.transform(rows)
+        for r in ranks:
+            residual = rows - basis.mean - coefficients[:, :r].dot(basis.components[:r])
+            absSum[r] += np.abs(residual).sum()
+            absMax[r] = max(absMax[r], np.abs(residual).max())
+        dist = np.sqrt((residual.reshape(len(rows), -1, 3) ** 2).sum(axis=-1))
+        if vertexSum is None:
+            vertexSum, vertexMax = dist.sum(axis=0), dist.max(axis=0)
+        else:
+            vertexSum += dist.sum(axis=0)
+            vertexMax = np.maximum(vertexMax, dist.max(axis=0))
+        n += len(rows)
+
+    ratio = np.cumsum(basis.explained_variance_ratio)
+    return OrderedDict([
+        ('ranks', [OrderedDict([('rank', r),
+                                ('explained_variance_ratio', float(ratio[r-1])),
+                                ('mae', absSum[r] / (n * len(basis.mean))),
+                                ('max_error', float(absMax[r]))]) for r in ranks]),
+        ('vertex_mean_error', vertexSum / n),
+        ('vertex_max_error', vertexMax),
+    ])
+
+
+def save_coefficients(basis, filename, output, chunk_size=512):
+    """Write the coefficients of all samples to an HDF5 file ('data', (N, rank)), as training targets."""
+    import tables
+    with tables.open_file(output, 'w') as fo:
+        data = fo.create_earray(fo.root, 'data', tables.Float32Atom(), (0, basis.rank))
+        for _, rows in iter_chunks(filename, chunk_size):
+            data.append(basis.transform(rows).astype(np.float32))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit a PCA basis of the vertex deltas in an HDF5 training set.')
+    parser.add_argument('data', help='HDF5 file with the vertex deltas (X_train.hdf5)')
+    parser.add_argument('-k', '--rank', type=int, default=128, help='Number of components')
+    parser.add_argument('-o', '--output', required=True, help='Basis file (.npz)')
+    parser.add_argument('-m', '--method', choices=['randomized', 'incremental'], default='randomized')
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--power-iterations', type=int, default=2, help='Power iterations of the randomized SVD')
+    parser.add_argument('--ranks', default='', help='Comma separated ranks to report the error of')
+    parser.add_argument('-r', '--report', default=None, help='Write the error report (with per vertex errors) to this json file')
+    parser.add_argument('-c', '--coefficients', default=None, help='Write the coefficients of all samples to this HDF5 file')
+    options = parser.parse_args(argv)
+    ranks = [int(r) for r in options.ranks.split(',') if r.strip()]
+    if any(not 1 <= r <= options.rank for r in ranks):
+        parser.error('--ranks must be in 1..%s' % options.rank)
+
+    t = time.time()
+    if options.method == 'randomized':
+        basis = randomized_basis(options.data, options.rank, options.chunk_size,
+                                 power_iterations=options.power_iterations)
+    else:
+        basis = incremental_basis(options.data, options.rank, options.chunk_size)
+    print('Fitted rank %s basis of %s samples in %.1fs' % (basis.rank, basis.n_samples, time.time() - t))
+    basis.save(options.output)
+
+    if any(r > basis.rank for r in ranks):
+        # fewer samples than components
+        print('Reporting ranks above %s at rank %s' % (basis.rank, basis.rank))
+        ranks = [min(r, basis.rank) for r in ranks]
+    report = evaluate(basis, options.data, ranks, options.chunk_size)
+    print('%8s %12s %12s %12s' % ('rank', 'explained', 'mae', 'max error'))
+    for row in report['ranks']:
+        print('%8d %12.6f %12.6g %12.6g' % tuple(row.values()))
+    worst = np.argsort(report['vertex_mean_error'])[::-1][:5]
+    print('worst vertices (mean error): %s' % ', '.join('%d (%.4g)' % (v, report['vertex_mean_error'][v]) for v in worst))
+    if options.report:
+        report['vertex_mean_error'] = report['vertex_mean_error'].tolist()
+        report['vertex_max_error'] = report['vertex_max_error'].tolist()
+        with open(options.report, 'w') as fo:
+            json.dump(report, fo, indent=2)
+    if options.coefficients:
+        save_coefficients(basis, options.data, options.coefficients, options.chunk_size)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
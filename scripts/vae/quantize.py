@@ -0,0 +1,189 @@
+"""
+Quantized export of the weights of a keras model, for a smaller download of
+the browser model.
+
+The large Dense kernels (at least min_size values, eg. the output layer of
+nb_targets x nb_vertices*3) are stored as int8 with a float32 scale per row,
+or as float16. Other weights stay float32. The weights are written as one
+binary blob (<prefix>.buf) and a json file with the layout (<prefix>.json),
+see blob.py:
+
+    {"version": 1, "weights": [{"layer_name", "weight_name", "shape",
+      "dtype": "float32" | "float16" | "int8", "offset", "length",
+      "scale_offset", "scale_length"}, ...]}
+
+offset and length are in bytes of the blob, and every array starts at a
+multiple of 4 bytes, so the browser can view it as a typed array. An int8
+kernel W of shape (rows, cols) is dequantized as W[r, c] = q[r, c] * scale[r].
+
+Usage:
+    python -m scripts.vae.quantize model.hdf5 -o output/kerasjs_and_threejs/data/model_weights_q8 [--dtype float16] [-d data_dir]
+"""
+from __future__ import print_function
+import sys
+import json
+import zlib
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .blob import BlobWriter, BlobFile
+
+QUANTIZED_VERSION = 1
+INT8_MAX = 127
+DTYPES = ['int8', 'float16']
+# kernels smaller than this are not worth quantizing
+MIN_SIZE = 1 << 16
+
+
+def quantize(array, dtype='int8'):
+    """Quantize a 2d array. Returns the quantized array and the per row scales (None for float16)."""
+    array = np.asarray(array, dtype=np.float32)
+    if dtype == 'float16':
+        return array.astype(np.float16), None
+    elif dtype != 'int8':
+        raise ValueError('Unknown quantized dtype %s, must be one of %s' % (dtype, DTYPES))
+    amax = np.abs(array).max(axis=1)
+    scale = np.where(amax > 0, amax / INT8_MAX, 1.0).astype(np.float32)
+    return np.round(array / scale[:, None]).astype(np.int8), scale
+
+
+def dequantize(array, scale=None):
+    """Inverse of quantize(), as float32."""
+    if scale is None:
+        return np.asarray(array, dtype=np.float32)
+    return array.astype(np.float32) * scale[:, None]
+
+
+def model_weights(model):
+    """The weights of a keras model, as an OrderedDict of (layer name, weight name) -> array."""
+    weights = OrderedDict()
+    for layer in model.layers:
+        for w, value in zip(layer.weights, layer.get_weights()):
+            weights[(layer.name, w.name)] = value
+    return weights
+
+
+def set_model_weights(model, weights):
+    """Set the weights of a keras model from an OrderedDict like model_weights()."""
+    for layer in model.layers:
+        if layer.weights:
+            layer.set_weights([weights[(layer.name, w.name)] for w in layer.weights])
+
+
+class QuantizedWeights(BlobFile):
+    """Weights in the blob layout, see the module docstring."""
+
+    VERSION = QUANTIZED_VERSION
+    DESCRIPTION = 'quantized weights'
+
+    @classmethod
+    def from_weights(cls, weights, dtype='int8', min_size=MIN_SIZE):
+        writer = BlobWriter()
+        layout = []
+        for (layerName, weightName), value in weights.items():
+            entry = OrderedDict([('layer_name', layerName), ('weight_name', weightName),
+                                 ('shape', list(value.shape))])
+            if value.ndim == 2 and value.size >= min_size:
+                quantized, scale = quantize(value, dtype)
+                entry['dtype'] = dtype
+                entry['offset'], entry['length'] = writer.append(quantized)
+                if scale is not None:
+                    entry['scale_offset'], entry['scale_length'] = writer.append(scale)
+            else:
+                entry['dtype'] = 'float32'
+                entry['offset'], entry['length'] = writer.append(value.astype(np.float32))
+            layout.append(entry)
+        return cls(writer.getvalue(), {'version': QUANTIZED_VERSION, 'weights': layout})
+
+    def _array(self, dtype, offset, length, shape=None):
+        array = np.frombuffer(self.blob, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=offset)
+        return array.reshape(shape) if shape is not None else array
+
+    def dequantized(self):
+        """The float32 weights, as an OrderedDict like model_weights() (the reference dequantizer)."""
+        weights = OrderedDict()
+        for entry in self.layout['weights']:
+            array = self._array(entry['dtype'], entry['offset'], entry['length'], entry['shape'])
+            scale = None
+            if 'scale_offset' in entry:
+                scale = self._array(np.float32, entry['scale_offset'], entry['scale_length'])
+            weights[(entry['layer_name'], entry['weight_name'])] = dequantize(array, scale)
+        return weights
+
+
+def size_report(weights, quantized):
+    """Raw and zlib compressed (as served with gzip) sizes of the float32 and the quantized weights."""
+    floatBlob = b''.join(np.ascontiguousarray(v, dtype=np.float32).tobytes() for v in weights.values())
+    return OrderedDict([('float32_bytes', len(floatBlob)),
+                        ('float32_compressed_bytes', len(zlib.compress(floatBlob, 6))),
+                        ('quantized_bytes', len(quantized.blob)),
+                        ('quantized_compressed_bytes', len(zlib.compress(quantized.blob, 6)))])
+
+
+def accuracy_report(model, quantized, params, batch_size=32):
+    """
+    Error of the model with dequantized weights against the float model, for
+    params (N, nb_targets). Restores the float weights of the model.
+    """
+    weights = model_weights(model)
+    expected = model.predict(params, batch_size=batch_size)
+    set_model_weights(model, quantized.dequantized())
+    try:
+        pred = model.predict(params, batch_size=batch_size)
+    finally:
+        set_model_weights(model, weights)
+    err = np.abs(pred - expected)
+    return OrderedDict([('mae', float(err.mean())),
+                        ('max_error', float(err.max())),
+                        ('relative_mae', float(err.mean() / max(np.abs(expected).mean(), 1e-12)))])
+
+
+def load_model(filename, weights=None):
+    """A keras model from a saved model, or from model json (model.to_json()) and a weights file."""
+    import keras
+    if filename.endswith('.json'):
+        with open(filename) as fi:
+            model = keras.models.model_from_json(fi.read())
+        model.load_weights(weights)
+        return model
+    return keras.models.load_model(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the weights of a keras model quantized to int8 or float16.')
+    parser.add_argument('model', help='Keras model (.hdf5), or model json (with --weights)')
+    parser.add_argument('-w', '--weights', default=None, help='Weights file, for a model json')
+    parser.add_argument('-o', '--output', required=True, help='Output prefix, writes <prefix>.buf and <prefix>.json')
+    parser.add_argument('--dtype', choices=DTYPES, default='int8')
+    parser.add_argument('--min-size', type=int, default=MIN_SIZE, help='Quantize 2d weights with at least this many values')
+    parser.add_argument('-d', '--data-dir', default=None, help='Training set to take params from for the accuracy report (default: random params)')
+    parser.add_argument('-n', '--samples', type=int, default=256)
+    parser.add_argument('-r', '--report', default=None, help='Write the report to this json file')
+    options = parser.parse_args(argv)
+
+    model = load_model(options.model, options.weights)
+    weights = model_weights(model)
+    quantized = QuantizedWeights.from_weights(weights, options.dtype, options.min_size)
+    quantized.save(options.output)
+
+    if options.data_dir:
+        from .morph_model import read_dataset, dataset_length
+        total = dataset_length(options.data_dir)
+        params = read_dataset(options.data_dir, max(0, total - options.samples), total)[2]
+    else:
+        params = np.random.RandomState(0).uniform(size=(options.samples,) + model.input_shape[1:]).astype(np.float32)
+    report = OrderedDict([('dtype', options.dtype), ('sizes', size_report(weights, quantized)),
+                          ('accuracy', accuracy_report(model, quantized, params))])
+    for section in ('sizes', 'accuracy'):
+        for key, value in report[section].items():
+            print('%-28s %.6g' % (key, value))
+    if options.report:
+        with open(options.report, 'w') as fo:
+            json.dump(report, fo, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Per modifier response tables, for instant single slider previews without
+running the keras model or makehuman.
+
+A universal (non macro) modifier moves the mesh piecewise linearly in its
+value: with the value at 0 as the kink, a value v on the decr side (v < 0)
+adds v / min times the decr response, on the incr side v / max times the
+incr response. So moving one slider from a to b is a sparse add of the
+responses. The responses are exact for the targets of the modifier alone;
+targets that also depend on macro factors are evaluated at the base values
+(default: the modifier defaults).
+
+The table is written like the quantized weights (see blob.py), as one
+binary blob (<prefix>.buf) and a json layout (<prefix>.json):
+
+    {"version": 1, "vertices": nVerts, "modifiers": [{"name", "min", "max",
+      "default", "sides": [{"side": "decr" | "incr", "value", "count",
+      "index_dtype": "uint16" | "uint32", "index_offset", "delta_offset",
+      "scale"}, ...]}, ...]}
+
+index_offset is the byte offset of the count vertex indices, delta_offset
+of the (count, 3) int16 deltas, dequantized as delta * scale. Every array
+starts at a multiple of 4 bytes.
+
+Usage:
+    python -m scripts.vae.responses morph_model.npz -o output/kerasjs_and_threejs/data/responses [--values base.json]
+"""
+from __future__ import print_function
+import sys
+import json
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .morph_model import MorphModel, quantize_offsets
+from .blob import BlobWriter, BlobFile
+
+RESPONSES_VERSION = 1
+
+
+def modifier_responses(model, j, base_values=None):
+    """
+    The responses of universal modifier j, a list of (side, value, vertex
+    indices, deltas (n, 3) float64) for the decr and incr sides it has.
+    """
+    m = model.modifiers[j]
+    if m['type'] != 'universal':
+        raise ValueError('Modifier %s is not a universal modifier' % m['name'])
+    values = model.values_array(model.defaults if base_values is None else base_values)
+    targets = model.modifier_targets(j)
+    sides = []
+    for side, value in (('decr', m['min']), ('incr', m['max'])):
+        if value == 0:
+            continue
+        ends = np.repeat(values, 2, axis=0)
+        ends[0, j] = 0
+        ends[1, j] = value
+        weights = model.target_weights(ends)[:, targets]
+        dense = np.zeros(model.base.shape)
+        for t, weight in zip(targets, weights[1] - weights[0]):
+            if weight:
+                verts, offsets = model.target_offsets(t)
+                dense[verts] += weight * offsets
+        verts = np.flatnonzero(dense.any(axis=1))
+        sides.append((side, value, verts, dense[verts]))
+    return sides
+
+
+class ResponseTable(BlobFile):
+    """Responses in the blob layout, see the module docstring."""
+
+    VERSION = RESPONSES_VERSION
+    DESCRIPTION = 'response table'
+
+    def __init__(self, blob, layout):
+        BlobFile.__init__(self, blob, layout)
+        self._modifiers = dict((m['name'], m) for m in layout['modifiers'])
+
+    @classmethod
+    def from_model(cls, model, base_values=None):
+        writer = BlobWriter()
+        indexDtype = np.uint16 if len(model.base) <= np.iinfo(np.uint16).max + 1 else np.uint32
+        modifiers = []
+        for j, m in enumerate(model.modifiers):
+            if m['type'] != 'universal':
+                continue
+            entry = OrderedDict([('name', m['name']), ('min', m['min']), ('max', m['max']),
+                                 ('default', m['default']), ('sides', [])])
+            for side, value, verts, deltas in modifier_responses(model, j, base_values):
+                quantized, scale = quantize_offsets(deltas)
+                entry['sides'].append(OrderedDict([
+                    ('side', side), ('value', value), ('count', len(verts)),
+                    ('index_dtype', np.dtype(indexDtype).name),
+                    ('index_offset', writer.append(verts.astype(indexDtype))[0]),
+                    ('delta_offset', writer.append(quantized)[0]),
+                    ('scale', scale)]))
+            modifiers.append(entry)
+        layout = OrderedDict([('version', RESPONSES_VERSION), ('vertices', len(model.base)),
+                              ('modifiers', modifiers)])
+        return cls(writer.getvalue(), layout)
+
+    @property
+    def names(self):
+        return [m['name'] for m in self.layout['modifiers']]
+
+    def response(self, name, side):
+        """Vertex indices and float32 deltas of a side ('decr' or 'incr') of a modifier."""
+        for entry in self._modifiers[name]['sides']:
+            if entry['side'] == side:
+                verts = np.frombuffer(self.blob, dtype=entry['index_dtype'], count=entry['count'],
+                                      offset=entry['index_offset'])
+                deltas = np.frombuffer(self.blob, dtype=np.int16, count=3 * entry['count'],
+                                       offset=entry['delta_offset']).reshape(-1, 3)
+                return verts, (deltas * entry['scale']).astype(np.float32)
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.float32)
+
+    def amounts(self, name, value):
+        """Amount of each side, as a dict of side -> amount, of a modifier at value."""
+        m = self._modifiers[name]
+        value = min(max(value, m['min']), m['max'])
+        return dict((entry['side'], value / entry['value'] if value * entry['value'] > 0 else 0.0)
+                    for entry in m['sides'])
+
+    def apply(self, coords, name, old, new):
+        """Move coords (nVerts, 3), in place, for a change of modifier name from old to new (the reference client)."""
+        before = self.amounts(name, old)
+        after = self.amounts(name, new)
+        for side in after:
+            change = after[side] - before[side]
+            if change:
+                verts, deltas = self.response(name, side)
+                coords[verts] += change * deltas
+        return coords
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the per modifier response table of a morph model.')
+    parser.add_argument('morph_model', help='Morph model (.npz), see wrap_mh/morph_export.py')
+    parser.add_argument('-o', '--output', required=True, help='Output prefix, writes <prefix>.buf and <prefix>.json')
+    parser.add_argument('--values', default=None,
+                        help='json dict of modifier values of the base human (default: the modifier defaults)')
+    options = parser.parse_args(argv)
+
+    model = MorphModel.load(options.morph_model)
+    baseValues = None
+    if options.values:
+        with open(options.values) as fi:
+            baseValues = json.load(fi)
+    table = ResponseTable.from_model(model, baseValues)
+    table.save(options.output)
+    sides = [s for m in table.layout['modifiers'] for s in m['sides']]
+    print('Wrote responses of %s modifiers (%s sides, %s vertex deltas), %s bytes' % (
+        len(table.layout['modifiers']), len(sides), sum(s['count'] for s in sides), len(table.blob)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Make and export many humans from a file of human specs.
+
+Usage:
+    python -m scripts.wrap_mh.batch specs.jsonl -o output_dir [-j 4] [-m results.jsonl]
+
+Specs are read from JSONL (one json object per line) or CSV (one spec per row).
+A spec can have:
+    - name: base name of the output files (default: item_<line number>)
+    - output: output path without extension (default: <output_dir>/<name>)
+    - formats: list of export formats (obj, stl, dae, fbx, mesh, mesh.xml), default obj
+    - modifier: dict (or list of pairs) of modifier values
+    - age, gender, race, rig, material: as for humanargparser
+    - proxy: list of [type, file] pairs
+    - pose: bvh or mhp file, applied after the rig
+In CSV files formats are separated by ';', proxies are written as type=file
+separated by ';', and every column with a '/' in its name is a modifier value.
+
+Makehuman is initialized once (from the runtime snapshot if it was saved, see
+snapshot.py), worker processes are forked from the warm process. Results are appended to the
+results manifest (JSONL) as soon as each item is done, with the outputs,
+per-stage timing and the error of failed items.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+from .config import mhpath
+from .args import get_default_args
+from .wrapper import callMakeHuman, add_pose, _import_mh2stl
+from .import_mh import headless, resources
+
+logger = logging.getLogger('wrap_mh')
+
+EXPORT_FORMATS = ['obj', 'stl', 'dae', 'fbx', 'mesh', 'mesh.xml']
+SPEC_KEYS = ['age', 'gender', 'race', 'rig', 'material', 'pose']
+
+
+def read_specs(filename):
+    """Read human specs from a JSONL or CSV file, returns a list of dicts."""
+    if os.path.splitext(filename)[1].lower() == '.csv':
+        return _read_csv_specs(filename)
+    specs = []
+    with open(filename, 'rb') as fi:
+        for i, line in enumerate(fi):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            spec = json.loads(line, object_pairs_hook=OrderedDict)
+            spec.setdefault('name', 'item_%s' % (i + 1))
+            specs.append(spec)
+    return specs
+
+
+def _read_csv_specs(filename):
+    specs = []
+    with open(filename, 'rb') as fi:
+        for i, row in enumerate(csv.DictReader(fi)):
+            spec = OrderedDict()
+            modifiers = OrderedDict()
+            for key, value in row.items():
+                value = value.strip() if value else value
+                if not value:
+                    continue
+                if '/' in key:
+                    modifiers[key] = float(value)
+                elif key == 'formats':
+                    spec['formats'] = [f.strip() for f in value.split(';') if f.strip()]
+                elif key == 'proxy':
+                    spec['proxy'] = [p.strip().split('=', 1) for p in value.split(';') if p.strip()]
+                elif key in ('age', 'gender'):
+                    spec[key] = float(value)
+                else:
+                    spec[key] = value
+            spec['modifier'] = modifiers
+            spec.setdefault('name', 'item_%s' % (i + 2))  # line number, after the header
+            specs.append(spec)
+    return specs
+
+
+def spec_to_args(spec, output_dir):
+    """Makehuman args for a spec, and the output paths without extension."""
+    args = get_default_args(spec['name'])
+    for key in SPEC_KEYS:
+        if spec.get(key) is not None:
+            args[key] = spec[key]
+    modifiers = spec.get('modifier') or []
+    if isinstance(modifiers, dict):
+        modifiers = modifiers.items()
+    args['modifier'] = [(m, float(v)) for m, v in modifiers]
+    args['proxy'] = [list(p) for p in spec.get('proxy') or []]
+    output = spec.get('output') or os.path.join(output_dir, spec['name'])
+    args['output'] = os.path.abspath(output)
+    return args
+
+
+def export_human(human, filepath):
+    """Export a human, the format is determined by the file extension."""
+    with mhpath:
+        if filepath.lower().endswith('.stl'):
+            _import_mh2stl().exportStlBatch([human], [filepath])
+        else:
+            headless.save(human, filepath)
+
+
+def process_spec(item):
+    """Make and export the human of a spec. Returns the result record."""
+    idx, spec, output_dir = item
+    result = OrderedDict([('index', idx), ('name', spec.get('name')),
+                          ('outputs', []), ('timing', OrderedDict()), ('error', None)])
+    start = t = time.time()
+    stage = 'args'
+    try:
+        formats = spec.get('formats') or ['obj']
+        for fmt in formats:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError('Unknown export format "%s", must be one of %s' % (fmt, EXPORT_FORMATS))
+        args = spec_to_args(spec, output_dir)
+        if not os.path.isdir(os.path.dirname(args['output'])):
+            os.makedirs(os.path.dirname(args['output']))
+
+        stage = 'model'
+        args = callMakeHuman(args)
+        human = args['human']
+        t = _lap(result, stage, t)
+
+        if args.get('pose'):
+            stage = 'pose'
+            add_pose(args['pose'], human)
+            t = _lap(result, stage, t)
+
+        stage = 'export'
+        for fmt in formats:
+            filepath = '%s.%s' % (args['output'], fmt)
+            export_human(human, filepath)
+            result['outputs'].append(filepath)
+        t = _lap(result, stage, t)
+    except Exception as e:
+        result['error'] = '%s failed: %s: %s' % (stage, type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['timing']['total'] = time.time() - start
+    return result
+
+
+def _lap(result, stage, t):
+    now = time.time()
+    result['timing'][stage] = now - t
+    return now
+
+
+def run_batch(specs, output_dir, manifest=None, jobs=1):
+    """
+    Process specs with a pool of jobs workers, appending each result to the
+    manifest file (JSONL) as it completes. Returns the results, in order of
+    completion.
+    """
+    items = [(i, spec, output_dir) for i, spec in enumerate(specs)]
+    if jobs > 1:
+        # fork after initialization, so every worker starts from the warm runtime
+        resources.human
+        pool = multiprocessing.Pool(jobs)
+        results_iter = pool.imap_unordered(process_spec, items)
+    else:
+        pool = None
+        results_iter = (process_spec(item) for item in items)
+
+    results = []
+    fo = open(manifest, 'ab') if manifest else None
+    try:
+        for result in results_iter:
+            results.append(result)
+            if fo:
+                fo.write(json.dumps(result) + '\n')
+                fo.flush()
+            if result['error']:
+                logger.error('%s: %s', result['name'], result['error'])
+            else:
+                logger.info('%s: %s in %.2fs', result['name'], ', '.join(result['outputs']), result['timing']['total'])
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+        if fo:
+            fo.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Make and export many humans from a JSONL or CSV file of specs.')
+    parser.add_argument('specs', help='JSONL or CSV file with one human spec per line')
+    parser.add_argument('-o', '--output-dir', default='.', help='Directory for outputs without an explicit output path')
+    parser.add_argument('-m', '--manifest', default=None, help='Results manifest (JSONL), default <output_dir>/results.jsonl')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes')
+    options = parser.parse_args(argv)
+
+    specs = read_specs(options.specs)
+    output_dir = os.path.abspath(options.output_dir)
+    manifest = options.manifest or os.path.join(output_dir, 'results.jsonl')
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    results = run_batch(specs, output_dir, manifest, options.jobs)
+    failed = sum(1 for r in results if r['error'])
+    print "%d of %d humans done, %d failed, results in %s" % (len(results) - failed, len(results), failed, manifest)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,3 +4,7 @@ import os
 mhpath = Path(__file__).abspath().dirname().joinpath('..', '..', 'vendor/makehuman-commandline/makehuman')
 print(mhpath)
 ctmconv_path = Path(os.path.abspath('vendor/OpenCTM-master/tools'))
+# On-disk caches of directory scans and parsed data, see disk_cache.py
+cache_dir = Path(os.environ.get('WRAP_MH_CACHE_DIR', Path(__file__).abspath().dirname().joinpath('..', '..', 'cache')))
+# Snapshot of the initialized makehuman runtime, see snapshot.py
+snapshot_dir = Path(os.environ.get('WRAP_MH_SNAPSHOT_DIR', cache_dir.joinpath('mh_snapshot')))
@@ -0,0 +1,102 @@
+"""
+On-disk cache of directory scans and parsed data files, validated by mtime.
+
+Directory scans store the mtime of every directory they walked. A scan is
+still valid when none of those directories changed, which only needs a stat
+per directory instead of listing every file again (adding or removing a file
+or subdirectory changes the mtime of its parent directory).
+"""
+import os
+import json
+import hashlib
+import logging
+import cPickle as pickle
+from collections import OrderedDict
+
+from .config import cache_dir
+
+logger = logging.getLogger('wrap_mh')
+
+
+def _cache_file(kind, key):
+    return os.path.join(cache_dir, kind, hashlib.sha1(repr(key)).hexdigest() + '.pkl')
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as fi:
+            return pickle.load(fi)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as e:
+        if os.path.isfile(path):
+            logger.warning('Could not read cache file %s: %s', path, e)
+        return None
+
+
+def _write(path, data):
+    """Write atomically, so concurrent readers never see a partial file."""
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as fo:
+            pickle.dump(data, fo, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write cache file %s: %s', path, e)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def search(paths, extensions, recursive=True):
+    """
+    Like getpath.search: list files under paths with one of the extensions,
+    but cached on disk until one of the scanned directories changes.
+    """
+    paths = [os.path.abspath(p) for p in paths]
+    extensions = [e.lower() for e in extensions]
+    path = _cache_file('scan', (paths, sorted(extensions), recursive))
+
+    cached = _read(path)
+    if cached is not None and all(_mtime(d) == t for d, t in cached['dirs']):
+        return list(cached['files'])
+
+    files = []
+    dirs = []
+    for p in paths:
+        # missing dirs are recorded too, so they are noticed when created
+        dirs.append((p, _mtime(p)))
+        if not os.path.isdir(p):
+            continue
+        for root, dirnames, filenames in os.walk(p):
+            dirnames.sort()
+            if root != p:
+                dirs.append((root, _mtime(root)))
+            for f in sorted(filenames):
+                if os.path.splitext(f)[1].lower() in extensions:
+                    files.append(os.path.join(root, f))
+            if not recursive:
+                break
+    _write(path, {'dirs': dirs, 'files': files})
+    return files
+
+
+def load_json(filename, object_pairs_hook=OrderedDict):
+    """json.load a file, cached on disk until the file changes."""
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    stamp = (st.st_mtime, st.st_size)
+    path = _cache_file('json', filename)
+
+    cached = _read(path)
+    if cached is not None and cached['stamp'] == stamp:
+        return cached['data']
+
+    with open(filename, 'rb') as fi:
+        data = json.load(fi, object_pairs_hook=object_pairs_hook)
+    _write(path, {'stamp': stamp, 'data': data})
+    return data
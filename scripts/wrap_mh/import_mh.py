@@ -1,10 +1,12 @@
 import os
 import sys
-import json
+import threading
 from collections import OrderedDict
 
 from .mh_helpers import clean, short_hash, clean_modifier
-from .config import mhpath
+from .config import mhpath, snapshot_dir
+from .snapshot import RuntimeSnapshot
+from . import disk_cache
 
 #===============================================================================
 # Import Makehuman resources, needs to be with makehuman dir as current dir
@@ -43,9 +45,41 @@ with mhpath:
     import autoskinblender
     import export
 
+class lazy_resource(object):
+    """
+    Property that loads a resource on first access and memoizes it in
+    `_<name>` on the instance (which can also be set directly, e.g. from a
+    snapshot). First access is locked, so concurrent threads load it only once.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.attr = '_' + loader.__name__
+        self.__doc__ = loader.__doc__
+        self.lock = threading.RLock()
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.attr, None)
+        if value is None:
+            with self.lock:
+                value = getattr(obj, self.attr, None)
+                if value is None and hasattr(obj, 'restore_snapshot'):
+                    # the snapshot can provide it
+                    obj.restore_snapshot()
+                    value = getattr(obj, self.attr, None)
+                if value is None:
+                    value = self.loader(obj)
+                    setattr(obj, self.attr, value)
+        return value
+
+
 class MHStaticResources(object):
     """
-    Get makehuman resources once, so webapp can access them. Cache some tasks too
+    Get makehuman resources once, so webapp can access them. Each resource is
+    only loaded when it is first used, and directory scans and json files are
+    cached on disk.
     """
 
     def add_mh_paths(self):
@@ -61,21 +95,19 @@ class MHStaticResources(object):
                 else:
                     break
 
-    #@cache_disk
-    @property
+    @lazy_resource
     def modifiers(self):
-        if self._modifiers is None:
-            print "Loading modifiers"
-            with self.mhpath:
-                global mods_loaded
-                humanargparser.mods_loaded = False
-                self._modifiers = humanargparser._loadModifiers(None)
-                self._modifiers.sort()
-                # add a couple of properties for convenience
-                for m in self._modifiers:
-                    m.cleanname = clean_modifier(m.name)
-                    m.shortname = short_hash(m.fullName)
-        return self._modifiers
+        """Modeling and measurement modifiers, not attached to a human."""
+        print "Loading modifiers"
+        with self.mhpath:
+            humanargparser.mods_loaded = False
+            modifiers = humanargparser._loadModifiers(None)
+            modifiers.sort()
+            # add a couple of properties for convenience
+            for m in modifiers:
+                m.cleanname = clean_modifier(m.name)
+                m.shortname = short_hash(m.fullName)
+        return modifiers
 
     def named_modifiers(self):
         """For convenience put modifiers in a dict with fullname as key."""
@@ -99,45 +131,31 @@ class MHStaticResources(object):
             else:
                 paths = [getpath.getDataPath(foldername),
                          getpath.getSysDataPath(foldername)]
-        return list(getpath.search(paths, extensions, recursive))
+            return disk_cache.search(paths, extensions, recursive)
 
-    #@cache_disk
-    @property
+    @lazy_resource
     def targets(self):
         """Load makehuman targets"""
-        if self._targets is None:
-            cwd = os.path.abspath('.')
-            with self.mhpath:
-                global _targets
-                try:
-                    _targets == None
-                except NameError:
-                    print "loading targets"
-                    self._targets = mhtargets.getTargets()
-                else:
-                    print "targets preloaded"
-        return self._targets
+        print "Loading targets"
+        with self.mhpath:
+            return mhtargets.getTargets()
 
-    #@cache_disk
-    @property
+    @lazy_resource
     def proxies(self):
-        if self._proxies is None:
-            print "Loading proxies"
-            cwd = os.path.abspath('.')
-            with self.mhpath:
-                mhproxy.ProxyTypes
-                self._proxies = OrderedDict()
-                for proxyType in mhproxy.ProxyTypes:
-                    files = list(self._listDataFiles(proxyType.lower(),
-                                                     ['.proxy', '.mhclo']))
-                    for f in files:
-                        if proxyType not in self._proxies.keys():
-                            self._proxies[proxyType] = OrderedDict()
-                        filesname = clean(os.path.splitext(os.path.basename(f))[0])
-                        self._proxies[proxyType][filesname] = f
-            #if 'Proxymeshes' in self._proxies:
-            #    self._proxies.pop('Proxymeshes') # not supported in mh-cmd yet
-        return self._proxies
+        """Proxy files by proxy type and cleaned name."""
+        print "Loading proxies"
+        proxies = OrderedDict()
+        with self.mhpath:
+            for proxyType in mhproxy.ProxyTypes:
+                files = self._listDataFiles(proxyType.lower(), ['.proxy', '.mhclo'])
+                for f in files:
+                    if proxyType not in proxies:
+                        proxies[proxyType] = OrderedDict()
+                    filesname = clean(os.path.splitext(os.path.basename(f))[0])
+                    proxies[proxyType][filesname] = f
+        #if 'Proxymeshes' in proxies:
+        #    proxies.pop('Proxymeshes') # not supported in mh-cmd yet
+        return proxies
 
     def reverse_proxies(self):
         """Make reverse proxies."""
@@ -147,44 +165,67 @@ class MHStaticResources(object):
             revProxies[k] = dict(zip(d.values(), d.keys()))
         return revProxies
 
-    @property
-    def sliders(self, filename=None):
+    @lazy_resource
+    def modeling_sliders(self):
         """
         make a nested dict to generate controls. From mhpath
 
         sort modifiers into ordered dict with values of (label,OrderedDict) with the end of each branch ending in a (catagory,[(label,modifiers),(label2,modifiers2)...])
         """
-        if not filename:
-            filename = os.path.join(self.mhpath, 'data', 'modifiers',
-                                    'modeling_sliders.json')
-        if self._modeling_sliders is None:
-            print "Loading modeling sliders"
-            with self.mhpath:
-                # from guimodifier in makehuman
-                self._modeling_sliders = ['Traits', OrderedDict(), 'M']
-                moddict = OrderedDict((m.fullName, m) for m in self.modifiers)
-                with open(filename, 'r') as fi:
-                    data = json.load(fi)
-                for taskName, taskViewProps in data.items():
-                    sName = taskViewProps.get('saveName', None)
-                    label = taskViewProps.get('label', taskName)
-                    self._modeling_sliders[1][sName] = (label, OrderedDict(), sName)
-                    for sliderCategory, sliderDefs in taskViewProps[
-                            'modifiers'].items():
-                        self._modeling_sliders[1][sName][1][clean(
-                            sliderCategory)] = (sliderCategory.capitalize(), [],
-                                                sliderCategory.capitalize())
-                        for sDef in sliderDefs:
-                            modifierName = sDef['mod']
-                            modifier = moddict[modifierName]
-                            label = sDef.get('label', None)
-                            self._modeling_sliders[1][sName][1][clean(
-                                sliderCategory)][1].append([label, modifier, label
-                                                            ])
-        return self._modeling_sliders
+        filename = os.path.join(self.mhpath, 'data', 'modifiers',
+                                'modeling_sliders.json')
+        print "Loading modeling sliders"
+        with self.mhpath:
+            # from guimodifier in makehuman
+            sliders = ['Traits', OrderedDict(), 'M']
+            moddict = self.named_modifiers()
+            data = disk_cache.load_json(filename)
+            for taskName, taskViewProps in data.items():
+                sName = taskViewProps.get('saveName', None)
+                label = taskViewProps.get('label', taskName)
+                sliders[1][sName] = (label, OrderedDict(), sName)
+                for sliderCategory, sliderDefs in taskViewProps[
+                        'modifiers'].items():
+                    sliders[1][sName][1][clean(
+                        sliderCategory)] = (sliderCategory.capitalize(), [],
+                                            sliderCategory.capitalize())
+                    for sDef in sliderDefs:
+                        modifierName = sDef['mod']
+                        modifier = moddict[modifierName]
+                        label = sDef.get('label', None)
+                        sliders[1][sName][1][clean(
+                            sliderCategory)][1].append([label, modifier, label
+                                                        ])
+        return sliders
+
+    @property
+    def sliders(self):
+        return self.modeling_sliders
+
+    def restore_snapshot(self):
+        """
+        Restore the resources from the snapshot, once. Returns whether they
+        come from the snapshot.
+        """
+        if self.snapshot is None:
+            return False
+        with self._snapshot_lock:
+            if not self._snapshot_tried:
+                self._snapshot_tried = True
+                with self.mhpath:
+                    self.snapshot.restore(self)
+        return self.snapshot.loaded
+
+    def save_snapshot(self):
+        """Save a snapshot of the resources and a new human, for faster startup of later processes."""
+        with self.mhpath:
+            self.snapshot.save(self, self.getHuman())
 
     def getHuman(self):
         """Load a human model with modifiers."""
+        if self.restore_snapshot():
+            with self.mhpath:
+                return self.snapshot.get_human()
         with self.mhpath:
             # maxFaces *uint* Number of faces per vertex (pole), None for default (min 4)
             human = Human(files3d.loadMesh(
@@ -196,16 +237,15 @@ class MHStaticResources(object):
                 getpath.getSysDataPath('modifiers/modeling_modifiers.json'), human)
             return human
 
-    @property
+    @lazy_resource
     def human(self):
-        if self._human:
-            return self._human
-        else:
-            self._human = self.getHuman()
-            return self._human
+        return self.getHuman()
 
-    def __init__(self, mhpath):
+    def __init__(self, mhpath, snapshot=None):
         self.mhpath = mhpath
+        self.snapshot = snapshot
+        self._snapshot_lock = threading.RLock()
+        self._snapshot_tried = False
         self._targets = None
         self._human = None
         self._modifiers = None
@@ -213,24 +253,42 @@ class MHStaticResources(object):
         self._modeling_sliders = None
 
 
+class LazyConsoleApp(headless.ConsoleApp, object):
+    """
+    The headless app, with the selected human loaded on first use instead of
+    when the app is made.
+    """
+
+    def __init__(self, resources):
+        self.resources = resources
+        self.log_window = None
+        self.splash = None
+        self.statusBar = None
+
+    @property
+    def selectedHuman(self):
+        return self.resources.human
+
+    @selectedHuman.setter
+    def selectedHuman(self, human):
+        self.resources._human = human
+
+
 def getHuman():
-    with mhpath:
-        thuman = Human(files3d.loadMesh(
-            getpath.getSysDataPath("3dobjs/base.obj"),
-            maxFaces=5))
-        humanmodifier.mods_loaded = False
-        modifiers = humanmodifier.loadModifiers(
-            getpath.getSysDataPath('modifiers/modeling_modifiers.json'), thuman)
-    return thuman
+    """A new human with modifiers."""
+    return resources.getHuman()
+
 
+def save_snapshot():
+    """Save the runtime snapshot, see snapshot.py (python -m scripts.wrap_mh.snapshot)."""
+    resources.save_snapshot()
 
-# init mh resources
-resources = MHStaticResources(mhpath=mhpath)
+
+# mh resources, restored from the snapshot (if there is an up to date one) on first use
+resources = MHStaticResources(mhpath=mhpath, snapshot=RuntimeSnapshot(mhpath, snapshot_dir))
 
 # Init console app
-with mhpath:
-    G.app = headless.ConsoleApp()
-G.app.selectedHuman = human = resources.getHuman()
+G.app = LazyConsoleApp(resources)
 headless.OBJExporter = None
 headless.MHXExporter = None
 headless.MhxConfig = None
@@ -0,0 +1,73 @@
+"""
+Measure every human of a training set with the makehuman MeasurementEngine,
+for the measurement codes of scripts/vae/index.py.
+
+The training set holds vertex deltas relative to the reference human (all
+params 0.5), so the meshes are the reference coordinates of the morph model
+plus the deltas. The output npz has one array per measure with a value per
+sample, in training set order: every ruler measure, 'surface', 'volume' and
+'height' (in cm).
+
+Usage:
+    python -m scripts.wrap_mh.measure_dataset data_dir morph_model.npz -o measurements.npz
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from .config import mhpath
+from .import_mh import resources
+
+try:
+    from ..vae.morph_model import MorphModel, read_dataset
+    from ..vae.pca import iter_chunks
+except ValueError:
+    # wrap_mh was imported as a top level package, with scripts/ on the path
+    from vae.morph_model import MorphModel, read_dataset
+    from vae.pca import iter_chunks
+
+# measures of a single value per mesh
+MEASURES = ['surface', 'volume', 'height']
+
+
+def measure_dataset(data_dir, morph_model, mode='metric', chunk_size=256):
+    """A dict of measure name -> array of one value per sample of the training set in data_dir."""
+    labels = read_dataset(data_dir, 0, 0)[0]
+    reference = morph_model.coords(morph_model.reference_values(labels))[0]
+    with mhpath:
+        import measurement
+        engine = measurement.MeasurementEngine.fromHuman(resources.human)
+    if engine.nVerts != len(reference):
+        raise ValueError('Morph model of %s vertices does not match the base mesh (%s)' % (len(reference), engine.nVerts))
+
+    result = {}
+    for _, rows in iter_chunks(os.path.join(data_dir, 'X_train.hdf5'), chunk_size):
+        measures = engine.measure(reference + rows.reshape((len(rows),) + reference.shape), mode)
+        for name, values in measures.items():
+            if name in MEASURES or name in engine.ruler.Measures:
+                result.setdefault(name, []).append(values)
+    return dict((name, np.concatenate(values)) for name, values in result.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the humans of a training set, for a measurements index.')
+    parser.add_argument('data_dir', help='Directory with X_train.hdf5, y_train.hdf5 and metadata.json')
+    parser.add_argument('morph_model', help='Morph model (.npz) of the training set, for the reference coordinates')
+    parser.add_argument('-o', '--output', required=True, help='Measurements file (.npz)')
+    parser.add_argument('--chunk-size', type=int, default=256)
+    options = parser.parse_args(argv)
+
+    t = time.time()
+    measurements = measure_dataset(options.data_dir, MorphModel.load(options.morph_model),
+                                   chunk_size=options.chunk_size)
+    np.savez(options.output, **measurements)
+    print "Measured %s samples (%s measures) in %.1fs" % (
+        len(measurements['height']), len(measurements), time.time() - t)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
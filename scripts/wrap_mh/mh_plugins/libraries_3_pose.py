@@ -109,36 +109,48 @@ class PoseLibraryTaskView(object):
         return animation.loadPoseFromMhpFile(filepath, self.human.getSkeleton())
 
     def loadBvh(self, filepath, convertFromZUp="auto"):
-        bvh_file = bvh.load(filepath, convertFromZUp)
-        self.autoScaleBVH(bvh_file)
-        return bvh_file.createAnimationTrack(self.human.getSkeleton())
-
-    def autoScaleBVH(self, bvh_file):
         """
-        Auto scale BVH translations by comparing upper leg length
+        Load a BVH file retargeted to the skeleton of the human. Retargeted
+        tracks are cached per BVH file and skeleton, so only the scale
+        depends on the human.
+        """
+        skel = self.human.getSkeleton()
+        anim, joint_lengths = bvh.loadRetargeted(filepath, skel, convertFromZUp)
+        scale_factor = self.getBVHScale(joint_lengths, os.path.basename(filepath))
+        if scale_factor is not None:
+            log.message("Scaling BVH file %s with factor %s" % (filepath, scale_factor))
+            anim.scale(scale_factor)
+        return anim
+
+    def getBVHScale(self, joint_lengths, bvh_name):
+        """
+        Factor to scale BVH translations by, comparing upper leg length.
+        joint_lengths maps BVH joint names to the length to their first child.
         """
-        import numpy.linalg as la
         skel=self.human.getSkeleton()
-        bones= skel.getBones()
         COMPARE_BONE=None
-        if "upperleg02.L" in bvh_file.joints:
+        if "upperleg02.L" in joint_lengths:
             COMPARE_BONE="upperleg02.L"
-#         else:
-#             for bone in bones:
-#                 if bone.name in bvh_file.joints:
-#                     COMPARE_BONE=bone.name
-#                     break
         if not COMPARE_BONE:
-            raise RuntimeError('Failed to auto scale BVH file %s, it does not contain a joint in common with "%s"' % (bvh_file.name, COMPARE_BONE))
-        bvh_joint = bvh_file.joints[COMPARE_BONE]
-        bone = self.human.getSkeleton().getBoneByReference(COMPARE_BONE)
+            raise RuntimeError('Failed to auto scale BVH file %s, it does not contain a joint in common with "%s"' % (bvh_name, COMPARE_BONE))
+        bone = skel.getBoneByReference(COMPARE_BONE)
         if bone is not None:
-            joint_length = la.norm(bvh_joint.children[0].position - bvh_joint.position)
-            scale_factor = bone.length / joint_length
+            return bone.length / joint_lengths[COMPARE_BONE]
+        else:
+            log.warning("Could not find bone or bone reference with name %s in skeleton %s, cannot auto resize BVH file %s", COMPARE_BONE, skel.name, bvh_name)
+            return None
+
+    def autoScaleBVH(self, bvh_file):
+        """
+        Auto scale BVH translations by comparing upper leg length
+        """
+        import numpy.linalg as la
+        joint_lengths = dict((joint.name, la.norm(joint.children[0].position - joint.position))
+                             for joint in bvh_file.getJoints() if joint.hasChildren())
+        scale_factor = self.getBVHScale(joint_lengths, bvh_file.name)
+        if scale_factor is not None:
             log.message("Scaling BVH file %s with factor %s" % (bvh_file.name, scale_factor))
             bvh_file.scale(scale_factor)
-        else:
-            log.warning("Could not find bone or bone reference with name %s in skeleton %s, cannot auto resize BVH file %s", COMPARE_BONE, self.human.getSkeleton().name, skel.name)
 
     def onShow(self, event):
         self.filechooser.refresh()
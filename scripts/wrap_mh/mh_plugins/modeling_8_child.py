@@ -47,11 +47,7 @@ import random
 def assignModifierValues(self, valuesDict):
     _tmp = self.human.symmetryModeEnabled
     self.human.symmetryModeEnabled = False
-    for mName, val in valuesDict.items():
-        try:
-            self.human.getModifier(mName).setValue(val)
-        except:
-            pass
+    self.human.setModifierValues(valuesDict, ignoreNotfound = True)
     self.human.applyAllTargets()
     self.human.symmetryModeEnabled = _tmp
 
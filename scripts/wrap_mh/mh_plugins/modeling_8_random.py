@@ -46,11 +46,7 @@ import random
 def assignModifierValues(human, valuesDict):
     _tmp = human.symmetryModeEnabled
     human.symmetryModeEnabled = False
-    for mName, val in valuesDict.items():
-        try:
-            human.getModifier(mName).setValue(val)
-        except:
-            pass
+    human.setModifierValues(valuesDict, ignoreNotfound = True)
     human.applyAllTargets()
     human.symmetryModeEnabled = _tmp
     return human
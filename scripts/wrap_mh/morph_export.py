@@ -0,0 +1,104 @@
+"""
+Export the modeling modifiers of makehuman as a morph model (see
+scripts/vae/morph_model.py): the modifier -> target weight logic and the
+quantized sparse targets the modifiers reference.
+
+Usage:
+    python -m scripts.wrap_mh.morph_export morph_model.npz [--no-check]
+"""
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+
+from .config import mhpath
+from .import_mh import getHuman, humanmodifier
+
+try:
+    from ..vae.morph_model import MorphModel
+except ValueError:
+    # wrap_mh was imported as a top level package, with scripts/ on the path
+    from vae.morph_model import MorphModel
+
+logger = logging.getLogger('wrap_mh')
+
+
+def modifier_definition(m):
+    """The definition of a modifier that a morph model needs to evaluate it."""
+    mdef = {'name': m.fullName, 'min': m.getMin(), 'max': m.getMax(), 'default': m.getDefaultValue()}
+    if isinstance(m, humanmodifier.MacroModifier):
+        mdef.update(type='macro', group=m.groupName, variable=m.variable.lower())
+    elif isinstance(m, humanmodifier.UniversalModifier):
+        mdef.update(type='universal', left=m.left, center=m.center, right=m.right)
+    else:
+        raise ValueError('Can not export modifier %s of type %s' % (m.fullName, type(m).__name__))
+    return mdef
+
+
+def make_morph_model(human=None):
+    """A morph model of the modifiers of a human (default: a new human)."""
+    if human is None:
+        human = getHuman()
+    with mhpath:
+        import algos3d
+        modifiers = [modifier_definition(m) for m in human.modifiers]
+        targets = []
+        seen = set()
+        for m in human.modifiers:
+            for tpath, factors in m.targets:
+                if tpath in seen:
+                    continue
+                seen.add(tpath)
+                target = algos3d.getTarget(human.meshData, tpath)
+                targets.append((tpath.replace('\\', '/'), factors, target.verts, target.data))
+        mesh = human.meshData
+        base = mesh.orig_coord
+        faceGroups = [fg.name for fg in mesh.faceGroups]
+        # the face group of each vertex (of one of its faces)
+        vertexGroup = np.full(len(base), -1, dtype=np.int16)
+        vertexGroup[mesh.fvert.ravel()] = np.repeat(mesh.group, mesh.fvert.shape[1])
+    return MorphModel.from_targets(base, targets, modifiers, faceGroups, vertexGroup)
+
+
+def check_morph_model(model, human, values):
+    """
+    Max abs difference between the morph model and makehuman for modifier
+    values (a dict). Changes the human.
+    """
+    with mhpath:
+        for name, value in values.items():
+            human.getModifier(name).setValue(value)
+        human.applyAllTargets()
+        # the model normalizes the ethnic values, so give it those of the human
+        values = dict((m.fullName, m.getValue()) for m in human.modifiers)
+    return float(np.abs(model.coords(values)[0] - human.meshData.coord).max())
+
+
+def export_morph_model(filename, check=True):
+    t = time.time()
+    model = make_morph_model()
+    model.save(filename)
+    logger.info('Exported morph model with %s targets to %s in %.1fs', model.nTargets, filename, time.time() - t)
+    if check:
+        human = getHuman()
+        rng = np.random.RandomState(0)
+        values = dict((name, rng.uniform(lo, hi)) for name, lo, hi in zip(model.modifier_names, model.mins, model.maxs))
+        error = check_morph_model(model, human, values)
+        print "Morph model max error against makehuman for random modifier values: %g" % error
+    return model
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the makehuman modeling modifiers as a morph model.')
+    parser.add_argument('output', help='Morph model file (.npz)')
+    parser.add_argument('--no-check', dest='check', action='store_false',
+                        help='Do not compare the model against makehuman for a random human')
+    options = parser.parse_args(argv)
+    export_morph_model(options.output, options.check)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""
+Snapshot of an initialized makehuman runtime.
+
+Initializing makehuman (scanning targets and proxies, building modifiers,
+decompressing targets, loading the base mesh) takes many seconds. A snapshot
+stores that state once, and new processes restore it instead of rebuilding it.
+
+A snapshot is a generation directory with:
+    - state.pkl: a header (version and data signature) followed by the small
+      payload (unbound modifiers, target index, proxy index, slider tree)
+    - base.mhmesh: the base mesh in the memory-mappable files3d format
+    - targets_verts.npy, targets_data.npy, targets_faces.npy: the arrays of
+      all modifier targets, concatenated. They are memory mapped on restore,
+      so processes share the pages and only read the targets they use.
+The file "current" in the snapshot directory names the generation. It is
+written last, so a crash while saving never leaves a mismatched set of
+files in use.
+
+The snapshot is saved by an explicit step, and processes restore it on
+first use of the makehuman resources:
+    python -m scripts.wrap_mh.snapshot [--force]
+
+The data signature covers the modifier definitions, the base mesh, the target
+archive and the directories holding targets and proxies, so the snapshot is
+rebuilt when any of them changes.
+"""
+import os
+import sys
+import shutil
+import argparse
+import hashlib
+import logging
+import cPickle as pickle
+from collections import OrderedDict
+
+logger = logging.getLogger('wrap_mh')
+
+SNAPSHOT_VERSION = 2
+TARGET_ARRAYS = ['verts', 'data', 'faces']
+
+# Data files and directories (relative to the makehuman dir) that the snapshot
+# depends on
+SIGNATURE_FILES = ['data/modifiers/modeling_modifiers.json',
+                   'data/modifiers/modeling_modifiers_desc.json',
+                   'data/modifiers/measurement_modifiers.json',
+                   'data/modifiers/measurement_modifiers_desc.json',
+                   'data/modifiers/modeling_sliders.json',
+                   'data/3dobjs/base.obj',
+                   'data/3dobjs/base.npz',
+                   'data/targets.npz']
+SIGNATURE_DIRS = ['data/targets', 'data/clothes', 'data/eyebrows',
+                  'data/eyelashes', 'data/eyes', 'data/hair',
+                  'data/proxymeshes', 'data/teeth', 'data/tongue']
+
+
+def data_signature(mhpath):
+    """Hash of mtimes and sizes of the data the snapshot was built from."""
+    hasher = hashlib.sha1(str(SNAPSHOT_VERSION))
+    for f in SIGNATURE_FILES:
+        p = os.path.join(mhpath, f)
+        if os.path.isfile(p):
+            st = os.stat(p)
+            hasher.update('%s:%s:%s;' % (f, st.st_mtime, st.st_size))
+    for d in SIGNATURE_DIRS:
+        # directory mtimes change when files are added or removed
+        for root, dirnames, filenames in os.walk(os.path.join(mhpath, d)):
+            dirnames.sort()
+            hasher.update('%s:%s;' % (os.path.relpath(root, mhpath), os.stat(root).st_mtime))
+    return hasher.hexdigest()
+
+
+class RuntimeSnapshot(object):
+    """
+    Save and restore the initialized state of MHStaticResources.
+    """
+
+    def __init__(self, mhpath, snapshot_dir):
+        self.mhpath = mhpath
+        self.snapshot_dir = snapshot_dir
+        self.current_file = os.path.join(snapshot_dir, 'current')
+        self._human_modifiers = None
+        self._generation_dir = None
+        self.loaded = False
+
+    def _files(self, generation_dir):
+        """State file, mesh file and target array files of a generation."""
+        return (os.path.join(generation_dir, 'state.pkl'),
+                os.path.join(generation_dir, 'base.mhmesh'),
+                [os.path.join(generation_dir, 'targets_%s.npy' % name) for name in TARGET_ARRAYS])
+
+    def _current_generation(self):
+        """The directory of the current generation, None if there is none."""
+        try:
+            with open(self.current_file, 'rb') as fi:
+                name = fi.read().strip()
+        except IOError:
+            return None
+        generation_dir = os.path.join(self.snapshot_dir, name)
+        state_file, mesh_file, target_files = self._files(generation_dir)
+        if not all(os.path.isfile(f) for f in [state_file, mesh_file] + target_files):
+            return None
+        return generation_dir
+
+    def is_valid(self):
+        """Whether a snapshot exists that matches the current data files."""
+        generation_dir = self._current_generation()
+        if generation_dir is None:
+            return False
+        state_file = self._files(generation_dir)[0]
+        try:
+            with open(state_file, 'rb') as fi:
+                header = pickle.load(fi)
+        except Exception as e:
+            logger.warning('Could not read snapshot header %s: %s', state_file, e)
+            return False
+        return header.get('version') == SNAPSHOT_VERSION and \
+            header.get('signature') == data_signature(self.mhpath)
+
+    def save(self, resources, human):
+        """
+        Snapshot the resources and the freshly loaded human. Loads all targets
+        referenced by modifiers first, so they end up in the snapshot.
+        """
+        import numpy as np
+        import algos3d
+        import files3d
+        import humanmodifier
+        import getpath
+
+        with self.mhpath:
+            targets = OrderedDict()
+            for m in resources.modifiers:
+                for tpath, _ in m.targets:
+                    target = algos3d.getTarget(human.meshData, tpath)
+                    # targets that failed to load have no faces, they are loaded (and fail) again lazily
+                    if hasattr(target, 'faces'):
+                        targets[target.name] = target
+            targets = targets.values()
+            human_modifiers = humanmodifier.loadModifiers(
+                getpath.getSysDataPath('modifiers/modeling_modifiers.json'), None)
+            header = {'version': SNAPSHOT_VERSION,
+                      'signature': data_signature(self.mhpath)}
+
+        # index of each target in the concatenated arrays
+        index = []
+        nVerts = nFaces = 0
+        for target in targets:
+            index.append((target.name, nVerts, nVerts + len(target.verts), nFaces, nFaces + len(target.faces),
+                          getattr(target, '_license', None)))
+            nVerts += len(target.verts)
+            nFaces += len(target.faces)
+        payload = {
+            'human_modifiers': pickle.dumps(human_modifiers, pickle.HIGHEST_PROTOCOL),
+            'resource_modifiers': resources.modifiers,
+            'targets': index,
+            'proxies': resources.proxies,
+            'sliders': self._dump_sliders(resources.sliders),
+        }
+
+        # write a new generation, and switch to it by replacing the current file,
+        # so concurrent workers never read a partial or mismatched snapshot
+        name = 'gen-%s-%s' % (header['signature'][:12], os.getpid())
+        generation_dir = os.path.join(self.snapshot_dir, name)
+        if os.path.isdir(generation_dir):
+            shutil.rmtree(generation_dir)
+        os.makedirs(generation_dir)
+        state_file, mesh_file, target_files = self._files(generation_dir)
+        files3d.saveMappedMesh(human.getSeedMesh(), mesh_file)
+        np.save(target_files[0], np.concatenate([np.asarray(t.verts, dtype=np.uint32) for t in targets]
+                                                or [np.zeros(0, dtype=np.uint32)]))
+        np.save(target_files[1], np.concatenate([np.asarray(t.data, dtype=np.float64).reshape(-1, 3) for t in targets]
+                                                or [np.zeros((0, 3))]))
+        np.save(target_files[2], np.concatenate([np.asarray(t.faces, dtype=np.uint32) for t in targets]
+                                                or [np.zeros(0, dtype=np.uint32)]))
+        with open(state_file, 'wb') as fo:
+            pickle.dump(header, fo, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(payload, fo, pickle.HIGHEST_PROTOCOL)
+        tmp_file = '%s.%s.tmp' % (self.current_file, os.getpid())
+        with open(tmp_file, 'wb') as fo:
+            fo.write(name)
+        os.rename(tmp_file, self.current_file)
+
+        # remove older generations, processes that still map them keep their files open
+        for other in os.listdir(self.snapshot_dir):
+            if other.startswith('gen-') and other != name:
+                shutil.rmtree(os.path.join(self.snapshot_dir, other), ignore_errors=True)
+        logger.info('Saved makehuman snapshot to %s', generation_dir)
+
+    def restore(self, resources):
+        """Restore resources from the snapshot. Returns False if there is no valid snapshot."""
+        if not self.is_valid():
+            return False
+        import numpy as np
+        import algos3d
+
+        generation_dir = self._current_generation()
+        state_file, _, target_files = self._files(generation_dir)
+        try:
+            with open(state_file, 'rb') as fi:
+                pickle.load(fi)  # header
+                payload = pickle.load(fi)
+            verts, data, faces = [np.load(f, mmap_mode='c') for f in target_files]
+        except Exception as e:
+            logger.warning('Could not restore snapshot %s: %s', generation_dir, e)
+            return False
+
+        for name, v0, v1, f0, f1, license in payload['targets']:
+            if name in algos3d._targetBuffer:
+                continue
+            target = algos3d.Target.__new__(algos3d.Target)
+            target.name = name
+            target.morphFactor = -1
+            target.verts = verts[v0:v1]
+            target.data = data[v0:v1]
+            target.faces = faces[f0:f1]
+            if license is not None:
+                target.setLicense(license)
+            algos3d._targetBuffer[name] = target
+
+        self._human_modifiers = payload['human_modifiers']
+        self._generation_dir = generation_dir
+        resources._modifiers = payload['resource_modifiers']
+        resources._proxies = payload['proxies']
+        resources._modeling_sliders = self._load_sliders(payload['sliders'], resources.named_modifiers())
+        self.loaded = True
+        logger.info('Restored makehuman snapshot from %s', generation_dir)
+        return True
+
+    def get_human(self):
+        """A new human on the snapshot base mesh, with modeling modifiers attached."""
+        import files3d
+        import module3d
+        from human import Human
+
+        mesh = module3d.Object3D('base.obj')
+        mesh.path = os.path.join(self.mhpath, 'data', '3dobjs', 'base.obj')
+        files3d.loadMappedMesh(mesh, self._files(self._generation_dir)[1])
+        human = Human(mesh)
+        # each human needs its own modifier objects
+        for m in pickle.loads(self._human_modifiers):
+            m.setHuman(human)
+        return human
+
+    @staticmethod
+    def _dump_sliders(sliders):
+        """Replace modifiers in the slider tree by their full names."""
+        label, tasks, short = sliders
+        out = OrderedDict()
+        for sName, (tlabel, categories, tshort) in tasks.items():
+            cats = OrderedDict()
+            for cName, (clabel, entries, cshort) in categories.items():
+                cats[cName] = (clabel, [[l, m.fullName, l2] for l, m, l2 in entries], cshort)
+            out[sName] = (tlabel, cats, tshort)
+        return [label, out, short]
+
+    @staticmethod
+    def _load_sliders(sliders, named_modifiers):
+        """Inverse of _dump_sliders."""
+        label, tasks, short = sliders
+        out = OrderedDict()
+        for sName, (tlabel, categories, tshort) in tasks.items():
+            cats = OrderedDict()
+            for cName, (clabel, entries, cshort) in categories.items():
+                cats[cName] = (clabel, [[l, named_modifiers[m], l2] for l, m, l2 in entries], cshort)
+            out[sName] = (tlabel, cats, tshort)
+        return [label, out, short]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Save the snapshot of the initialized makehuman runtime.')
+    parser.add_argument('--force', action='store_true', help='Save even if the snapshot is up to date')
+    options = parser.parse_args(argv)
+
+    from .import_mh import resources
+    if resources.snapshot.is_valid() and not options.force:
+        print "Snapshot %s is up to date" % resources.snapshot.snapshot_dir
+        return 0
+    resources.save_snapshot()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,7 @@ from .convert import convert_obj_ctm
 from .convert import convert_obj_three
 
 
-from import_mh import human, resources, humanargparser, autoskinblender, export, getHuman, humanmodifier, headless, autoskinblender, export, getpath, files3d
+from import_mh import resources, humanargparser, autoskinblender, export, getHuman, humanmodifier, headless, autoskinblender, export, getpath, files3d
 
 def callMakeHuman2CTM(argsr):
     """Background task to compile"""
@@ -51,8 +51,8 @@ def callMakeHuman(args):
 
         # this will force mh-cmd to blend colors for ethnicity
         # as the skin files don't do this and it I couldn't get it to work another way
-        _autoSkinBlender = autoskinblender.EthnicSkinBlender(args['human'])
-        args['human'].material._diffuseColor = _autoSkinBlender.getDiffuseColor()
+        # (only the color is needed, so no skin blender and litsphere textures are made)
+        args['human'].material._diffuseColor = autoskinblender.getDiffuseColor(args['human'])
     return args
 
 
@@ -105,11 +105,60 @@ def exportHumanToBuffer(args):
     args['outputs'] = objfiles
     return args
 
+
+def _import_mh2stl():
+    """The stl exporter of the makehuman plugins (plugin dirs are not valid module names)."""
+    import importlib
+    pluginpath = mhpath.joinpath('plugins')
+    if pluginpath not in sys.path:
+        sys.path.append(pluginpath)
+    return importlib.import_module('9_export_stl.mh2stl')
+
+
+def callMakeHuman2STL(argsList, binary=True, scale=1.0, feetOnGround=False):
+    """
+    Make and export many humans to stl, e.g. for 3d printing. Each args needs
+    an 'output' path. Humans are made one at a time on the warm runtime.
+    """
+    argsList = [args.copy() for args in argsList]
+    for args in argsList:
+        args['output'] = os.path.abspath(args['output'])
+
+    def makeHuman(idx):
+        args = callMakeHuman(argsList[idx])
+        return args.pop('human')
+
+    with mhpath:
+        mh2stl = _import_mh2stl()
+        outputs = mh2stl.exportStlBatch(makeHuman, [args['output'] for args in argsList],
+                                        binary=binary, scale=scale, feetOnGround=feetOnGround)
+    logger.info('exported %s stl files', len(outputs))
+    return outputs
+
+def measureHumans(argsList, mode='metric'):
+    """
+    Make humans from a list of args and measure them all at once. Returns a
+    dict with an array of values per measure (ruler measures, 'surface',
+    'volume', 'height' and 'bbox'), in the order of argsList.
+    """
+    with mhpath:
+        import measurement
+        coords = []
+        engine = None
+        for args in argsList:
+            h = callMakeHuman(args.copy())['human']
+            if engine is None:
+                engine = measurement.MeasurementEngine.fromHuman(h)
+            coords.append(h.meshData.coord.copy())
+        if engine is None:
+            return {}
+        return engine.measure(np.array(coords), mode)
+
 def make_child(args1, args2, args=None, name='c1', symmetry=1, macro=1, height=1, face=1, body=1):
     """Given parent args, generate a child by randomizing parameters between the parents."""
     random_values = modeling_8_child.randomizeArgs(args1['modifier'],
                                                    args2['modifier'],
-                                                   human,
+                                                   resources.human,
                                                    symmetry=1,
                                                    macro=1,
                                                    height=1,
@@ -143,7 +192,7 @@ def make_child(args1, args2, args=None, name='c1', symmetry=1, macro=1, height=1
         makeRandom = 0
         if mName in argsmd.keys():
             value = argsmd[mName]
-            m = human.getModifier(mName)
+            m = resources.human.getModifier(mName)
             default_value = m.getDefaultValue()
             if value == default_value:
                 makeRandom = 1
@@ -234,8 +283,8 @@ def add_pose(poseFile, phuman):
     """
     cwd = os.path.abspath('.')
     with mhpath:
-        import libraries_pose
-        pose = libraries_pose.PoseLibraryTaskView()
+        from .mh_plugins import libraries_3_pose
+        pose = libraries_3_pose.PoseLibraryTaskView()
         logger.info("human", phuman)
         pose.setHuman(phuman)
         pose.loadPose(poseFile, apply_pose=True)